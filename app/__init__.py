@@ -1,22 +1,20 @@
-from os import environ
+from datetime import datetime
+from glob import glob
+from ipaddress import ip_network
+from os import environ, path
 
-from flask import Flask, abort, render_template, request
+from flask import Flask, abort, render_template, request, send_from_directory, url_for
 from sqlalchemy import create_engine
-from sqlalchemy.engine.url import URL
+from sqlalchemy.engine.url import URL, make_url
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-import html2text
 import tzlocal
 from flask_sqlalchemy import SQLAlchemy
 
-timezone = tzlocal.get_localzone()
+from .compression import Compress
+from .converters import html_to_text
 
-summarizer = html2text.HTML2Text()
-summarizer.ignore_links = True
-summarizer.ignore_anchors = True
-summarizer.images_to_alt = True
-summarizer.ignore_emphasis = True
-summarizer.ignore_tables = True
+timezone = tzlocal.get_localzone()
 
 
 app = Flask(__name__)
@@ -32,7 +30,8 @@ app.config.update({
     'SERVER_NAME': f"{environ['PUBLIC_HOST']}:{environ['HTTP_PORT']}" if development else environ['PUBLIC_HOST'],
     # It's CURRENT_YEAR, people
     'PREFERRED_URL_SCHEME': 'http' if development else 'https',
-    'SQLALCHEMY_DATABASE_URI': URL(
+    # DATABASE_URL can point somewhere other than the Docker Compose database (e.g. for benchmarks)
+    'SQLALCHEMY_DATABASE_URI': environ.get('DATABASE_URL') or URL(
         drivername='mysql+mysqlconnector',
         username=environ['MYSQL_USER'],
         password=environ['MYSQL_PASSWORD'],
@@ -43,16 +42,76 @@ app.config.update({
         query={'charset': 'utf8mb4'},
     ),
     'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'SQLALCHEMY_ENGINE_OPTIONS': {
+        # Replace connections well before MariaDB's wait_timeout drops them on its end
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 3600)),
+        # Check a connection is still alive before using it (e.g. after the database restarted)
+        'pool_pre_ping': environ.get('DB_POOL_PRE_PING', '1') == '1',
+    },
+    # Rendered page cache (see cache.py), off by default in development so template changes show up
+    'PAGE_CACHE': environ.get('PAGE_CACHE', '0' if development else '1') == '1',
+    'PAGE_CACHE_SIZE': int(environ.get('PAGE_CACHE_SIZE', 256)),
+    'PAGE_CACHE_TTL': int(environ.get('PAGE_CACHE_TTL', 300)),
+    # Optional SQLite file to share cached pages between gunicorn workers
+    'PAGE_CACHE_PATH': environ.get('PAGE_CACHE_PATH'),
+    # How long a shared cache (i.e. the reverse proxy) may reuse a page without checking with us
+    'HTTP_CACHE_MAX_AGE': int(environ.get('HTTP_CACHE_MAX_AGE', 0)),
+    # Request timing / query instrumentation (see metrics.py)
+    'METRICS': environ.get('METRICS', '0') == '1',
+    # Queries taking at least this long are logged when METRICS is on
+    'SLOW_QUERY_MS': int(environ.get('SLOW_QUERY_MS', 200)),
+    # Networks (comma separated, e.g. the one Prometheus scrapes from) that may fetch /metrics
+    # directly, on top of requests from inside the container
+    'METRICS_ALLOW': [ip_network(n.strip(), strict=False)
+        for n in environ.get('METRICS_ALLOW', '').split(',') if n.strip()],
+    # Where book covers are stored (by `books new` / `books covers sync`) and served from
+    'COVERS_PATH': environ.get('COVERS_PATH', '/opt/covers'),
+    # Link the built (hashed, minified, pre-compressed) static files from ASSETS_PATH (see assets.py)
+    'ASSETS': environ.get('ASSETS', '0' if development else '1') == '1',
+    'ASSETS_PATH': environ.get('ASSETS_PATH', '/opt/assets'),
+    # Compress responses (see compression.py), off by default in development like the page cache
+    'COMPRESS': environ.get('COMPRESS', '0' if development else '1') == '1',
+    'COMPRESS_MIN_SIZE': int(environ.get('COMPRESS_MIN_SIZE', 500)),
+    'COMPRESS_GZIP_LEVEL': int(environ.get('COMPRESS_GZIP_LEVEL', 6)),
+    'COMPRESS_BROTLI_LEVEL': int(environ.get('COMPRESS_BROTLI_LEVEL', 5)),
+    # Compressed pages kept by each worker
+    'COMPRESS_CACHE_SIZE': int(environ.get('COMPRESS_CACHE_SIZE', 256)),
 })
+# Connection pool of each worker, by default each gunicorn thread can hold a connection. SQLite
+# (e.g. DATABASE_URL for benchmarks) doesn't keep a pool, so there's nothing to size
+if make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() != 'sqlite':
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        'pool_size': int(environ.get('DB_POOL_SIZE', environ.get('GUNICORN_THREADS', 1))),
+        'max_overflow': int(environ.get('DB_POOL_OVERFLOW', 2)),
+        # Seconds to wait for a connection when they're all in use
+        'pool_timeout': int(environ.get('DB_POOL_TIMEOUT', 30)),
+    })
+
+if app.config['COMPRESS']:
+    app.wsgi_app = Compress(app.wsgi_app, min_size=app.config['COMPRESS_MIN_SIZE'],
+            levels={'gzip': app.config['COMPRESS_GZIP_LEVEL'], 'br': app.config['COMPRESS_BROTLI_LEVEL']},
+            cache_size=app.config['COMPRESS_CACHE_SIZE'])
 
 db = SQLAlchemy(app)
 from . import models
 from .models import BlogPost, Book, BookTypes
+from .pagination import KeysetPagination
+from .cache import cached, validated, tag_versions
+from . import internal
+from . import assets
+
+@app.template_global()
+def page_args(args):
+    # Current query arguments (e.g. library search) with those for another page
+    current = {k: v for k, v in request.args.items() if k not in ('page', 'after', 'before')}
+    return dict(current, **args)
 
-@app.before_first_request
-def init_tables():
-    # Create tables defined above if they don't exist otherwise load them in
-    db.create_all()
+@app.template_global()
+def cover_url(book, size):
+    # Our copy of the cover if we have one, otherwise wherever Goodreads has it
+    if book.cover:
+        return url_for('cover', filename=Book.cover_file(book.cover, size))
+    return book.image_url
 
 @app.template_filter()
 def parse_type(book_type):
@@ -65,18 +124,58 @@ def post_date(time):
     return time.astimezone(timezone).strftime('%Y-%m-%d at %-H:%M')
 @app.template_filter()
 def html2text(text):
-    return summarizer.handle(text)
+    return html_to_text(text)
+
+def summarize(html):
+    # Plain text preview of a post shown on the home page, stored alongside the post
+    # so we don't have to convert the whole post on every request
+    return app.jinja_env.filters['truncate'](app.jinja_env, html_to_text(html))
+
+# Versions of pages for conditional requests (see validated())
+def templates_version():
+    # What every page is built from: the templates and the built static files they link
+    mtime = max(map(path.getmtime, glob(path.join(app.root_path, app.template_folder, '*.html'))))
+    built = assets.manifest_version()
+    return f'templates-{mtime}' + (f'-{built}' if built else ''), datetime.fromtimestamp(mtime, tz=timezone)
+def versioned(etag, last_modified):
+    # A page's own version combined with the templates', so deploying new ones isn't answered
+    # with 304s for the old markup
+    templates, deployed = templates_version()
+    return f'{etag}-{templates}', max(last_modified, deployed) if last_modified else None
+def posts_version():
+    # Deleting a post doesn't change any edit times, so the 'posts' generation is needed too
+    edited = db.session.query(db.func.max(BlogPost.edited)).scalar()
+    generation = tag_versions(['posts'])['posts']
+    return versioned(f'posts-{generation}-{edited.timestamp() if edited else 0}', edited)
+def post_version(id):
+    edited = db.session.query(BlogPost.edited).filter_by(id=id).scalar()
+    if not edited:
+        return None, None
+    # Bumped when every post's HTML is regenerated without editing them (posts rerender)
+    generation = tag_versions(['post-bodies'])['post-bodies']
+    return versioned(f'post-{id}-{generation}-{edited.timestamp()}', edited)
+def library_version(id=None):
+    # Books don't have edit times, the CLI bumps the library generation on every change
+    generation = tag_versions(['library'])['library']
+    return versioned(f'library-{generation}' if id is None else f'book-{id}-{generation}', None)
 
 
 @app.route('/')
+@validated(posts_version)
+@cached('posts')
 def home():
-    posts = BlogPost.query\
-            .order_by(BlogPost.time.desc())\
-            .paginate(per_page=10)
+    posts = KeysetPagination(BlogPost.list_query(),
+            [(BlogPost.time, True), (BlogPost.id, True)], per_page=10,
+            page=request.args.get('page'),
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            total_key='posts')
 
     return render_template("home.html", posts=posts)
 
 @app.route('/posts/<int:id>')
+@validated(post_version)
+@cached('post:{id}', 'post-bodies')
 def post(id):
     post = BlogPost.find_one(id)
     if not post:
@@ -85,19 +184,32 @@ def post(id):
     return render_template("post.html", post=post)
 
 @app.route('/about-us')
+@validated(templates_version)
 def about():
     return render_template("about-us.html")
 
 @app.route('/library/')
+@validated(library_version)
+@cached('library')
 def library():
     books = Book.find_all(**request.args)
     return render_template("search.html", books=books, **request.args)
 
 @app.route('/library/book/<id>')
+@validated(library_version)
+@cached('book:{id}')
 def book(id):
-    book = Book.query.filter_by(id=id).first_or_404()
+    book = Book.query.options(db.joinedload('authors'))\
+            .filter_by(id=id).first_or_404()
     return render_template('book.html', book=book)
 
+@app.route('/covers/<path:filename>')
+def cover(filename):
+    # Named after a hash of the image, so whatever is at a URL never changes
+    response = send_from_directory(app.config['COVERS_PATH'], filename, max_age=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    return response
+
 # This one will be a bit awkward as need way to write to openldap
 # from snark-www
 @app.route('/sign-up')
@@ -106,23 +218,28 @@ def sign_up():
 
 # Basic html page
 @app.route('/committee')
+@validated(templates_version)
 def committee():
     return render_template("committee.html")
 
 @app.route('/services')
+@validated(templates_version)
 def services():
     return render_template("services.html")
 
 @app.route('/wiki')
+@validated(templates_version)
 def wiki():
     return render_template("wiki.html")
 
 @app.route('/new-members')
+@validated(templates_version)
 def new_members():
     return render_template("new-members.html")
 
 # Not sure how accurate or necessary this page is
 @app.route('/file-storage')
+@validated(templates_version)
 def file_storage():
     return render_template("file-storage.html")
 
@@ -132,10 +249,15 @@ def mail_lists():
     return "Blah"
 
 @app.route("/slides")
+@validated(templates_version)
 def slides():
     return render_template("slides.html")
 
 @app.route("/login")
 def login():
     return "Must be a member"
- 
+
+# Last, so the filters it times are all registered
+if app.config['METRICS']:
+    from . import metrics
+    metrics.init()
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import mimetypes
+import re
+from os import path
+
+from flask import abort, redirect, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+from . import app
+
+# Static files as built by `website assets build` (see cli/assets.py): minified, named after a
+# hash of their contents and with gzip / brotli versions alongside, so browsers can keep them
+# forever. Templates link them with asset_url(), which falls back to the plain static files when
+# they haven't been built or ASSETS is off (in development, so changes show up straight away).
+
+MANIFEST = 'manifest.json'
+# Pre-compressed versions, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# style.0123456789ab.css -> style.css
+HASHED = re.compile(r'^(.+)\.[0-9a-f]{12}(\.[^.]+)$')
+
+_manifest = None
+
+def manifest():
+    """ Map of static files to their built names, read once by each worker """
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(path.join(app.config['ASSETS_PATH'], MANIFEST)) as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            _manifest = {}
+    return _manifest
+
+def manifest_version():
+    """ Short hash of the manifest, which changes whenever the built files do ('' when unused) """
+    if not app.config['ASSETS']:
+        return ''
+    return hashlib.sha256(json.dumps(manifest(), sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+@app.template_global()
+def asset_url(filename, **values):
+    """ url_for('static', filename=filename), but for the built version if there is one """
+    built = manifest().get(filename) if app.config['ASSETS'] else None
+    if built:
+        return url_for('asset', filename=built, **values)
+    return url_for('static', filename=filename, **values)
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    root = app.config['ASSETS_PATH']
+    if not path.isfile(safe_join(root, filename) or ''):
+        # A page cached before the assets were last built, point it at the current version
+        original = HASHED.match(filename)
+        current = manifest().get(''.join(original.groups())) if original else None
+        if not current:
+            abort(404)
+        return redirect(url_for('asset', filename=current))
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        if request.accept_encodings[encoding] and path.isfile(safe_join(root, filename + suffix)):
+            response = send_from_directory(root, filename + suffix, mimetype=mimetype, max_age=365 * 24 * 3600)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(root, filename, mimetype=mimetype, max_age=365 * 24 * 3600)
+    response.vary.add('Accept-Encoding')
+    # The name changes whenever the contents do
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,172 @@
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import wraps
+from time import time
+
+from flask import request, make_response
+
+from . import app, db
+from .models import CacheTag
+
+# Rendered pages are cached per worker in memory and optionally in a SQLite file shared by all
+# workers. Each entry remembers the versions of the tags it was rendered with (e.g. 'posts',
+# 'post:12'), the CLI bumps those versions in the database when it changes anything, so a
+# cached page is only served while everything it shows is unchanged.
+
+log = logging.getLogger(__name__)
+
+def tag_versions(tags):
+    versions = dict(db.session.query(CacheTag.tag, CacheTag.version)
+            .filter(CacheTag.tag.in_(tags)))
+    return {tag: versions.get(tag, 0) for tag in tags}
+
+def invalidate(*tags):
+    """ Mark everything cached under any of tags as stale """
+    for tag in tags:
+        updated = CacheTag.query.filter_by(tag=tag)\
+                .update({'version': CacheTag.version + 1}, synchronize_session=False)
+        if not updated:
+            db.session.add(CacheTag(tag=tag, version=1))
+    db.session.commit()
+
+class PageCache:
+    def __init__(self, size, ttl, path=None):
+        self.size = size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._local = threading.local()
+        if path:
+            with sqlite3.connect(path) as conn:
+                # Readers don't wait for the workers writing pages (and the other way around)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS pages '
+                        '(key TEXT PRIMARY KEY, expires REAL, versions TEXT, body TEXT)')
+
+    def _shared(self):
+        # sqlite3 connections can't be shared between threads
+        if not hasattr(self._local, 'conn'):
+            self._local.conn = sqlite3.connect(self.path, timeout=1)
+        return self._local.conn
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+        if not entry and self.path:
+            try:
+                row = self._shared().execute('SELECT expires, versions, body FROM pages WHERE key = ?',
+                        (key,)).fetchone()
+            except sqlite3.Error as e:
+                # e.g. locked by another worker for too long, just render the page
+                log.warning('Reading %s from the shared page cache failed: %s', key, e)
+                row = None
+            if row:
+                entry = (row[0], json.loads(row[1]), row[2])
+                self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get(self, key, versions):
+        """ Returns the cached body for key if it was cached with the current tag versions """
+        entry = self._lookup(key)
+        if entry:
+            expires, entry_versions, body = entry
+            if expires > time() and entry_versions == versions:
+                self.hits += 1
+                return body
+        self.misses += 1
+        return None
+
+    def set(self, key, versions, body):
+        entry = (time() + self.ttl, versions, body)
+        self._remember(key, entry)
+        if self.path:
+            try:
+                with self._shared() as conn:
+                    conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                            (key, entry[0], json.dumps(versions), body))
+                    # Every so often clear out expired pages (e.g. one-off searches)
+                    if self.misses % 100 == 0:
+                        conn.execute('DELETE FROM pages WHERE expires < ?', (time(),))
+            except sqlite3.Error as e:
+                # The other workers will have to render it themselves
+                log.warning('Writing %s to the shared page cache failed: %s', key, e)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+page_cache = PageCache(app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL'],
+        app.config['PAGE_CACHE_PATH'])
+
+def cached(*tags):
+    """ Cache a view's rendered page. tags may refer to the view's arguments, e.g. 'post:{id}' """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if not app.config['PAGE_CACHE']:
+                return view(**kwargs)
+
+            key = json.dumps([request.path, sorted(request.args.items(multi=True))])
+            # Versions are read before rendering so a change made while we're rendering
+            # can't be cached as current
+            versions = tag_versions([tag.format(**kwargs) for tag in tags])
+            body = page_cache.get(key, versions)
+            if body is None:
+                body = view(**kwargs)
+                # Only plain rendered pages are cached, not redirects, aborts etc.
+                if isinstance(body, str):
+                    page_cache.set(key, versions, body)
+            return body
+        return wrapper
+    return decorator
+
+def validated(validators):
+    """ Answer conditional requests for a view without running it. validators is called with the
+    view's arguments and returns an (etag, last_modified) pair describing the current version of
+    the page (last_modified may be None, and etag None if there's nothing to describe e.g. a
+    missing post) """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            etag, last_modified = validators(**kwargs)
+            if etag is None:
+                return view(**kwargs)
+            if last_modified:
+                # HTTP dates don't have sub-second precision
+                last_modified = last_modified.replace(microsecond=0)
+
+            if request.if_none_match:
+                # Weak, since compressed pages have weak ETags (see compression.py)
+                fresh = request.if_none_match.contains_weak(etag)
+            else:
+                fresh = bool(last_modified and request.if_modified_since
+                        and last_modified <= request.if_modified_since)
+            response = make_response(('', 304) if fresh else view(**kwargs))
+
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            # Shared caches can keep the page but have to check with us (cheaply) before reusing it
+            response.cache_control.public = True
+            if app.config['HTTP_CACHE_MAX_AGE']:
+                response.cache_control.s_maxage = app.config['HTTP_CACHE_MAX_AGE']
+            else:
+                response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
@@ -1,22 +1,26 @@
 import sys
 import os
 import argparse
+from importlib import import_module
 
 DEFAULT_EDITOR = os.environ.get('VISUAL', os.environ.get('EDITOR', 'nano'))
 
 class CLIError(Exception):
     pass
 
-from .. import app, init_tables
-from . import wp_import, blog, library
-from ..models import BookTypes
+from .. import app
+
+def command(module, name):
+    """ Runs module.name(args), importing the module only when the command is run - so e.g.
+    `posts list` doesn't have to load the Goodreads client """
+    def run_command(args):
+        return getattr(import_module(f'.{module}', __name__), name)(args)
+    return run_command
 
 def c_dev(_args):
     app.run(host='::', port=os.environ['HTTP_PORT'])
 
 def run():
-    init_tables()
-
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     subparsers = parser.add_subparsers(required=True, dest='command')
 
@@ -28,24 +32,54 @@ def run():
     p_app = subparsers.add_parser('app', help='Run the development server')
     p_app.set_defaults(func=c_dev)
 
+    # Database schema commands
+    p_db = subparsers.add_parser('db', help='Manage the database schema')
+    p_db.set_defaults(func=command('schema', 'status'))
+    db_sub = p_db.add_subparsers(dest='db_command')
+    db_migrate = db_sub.add_parser('migrate', help='Create tables and apply schema changes that haven\'t been applied yet')
+    db_migrate.set_defaults(func=command('schema', 'migrate'))
+    db_status = db_sub.add_parser('status', help='Show the schema version and pending migrations')
+    db_status.set_defaults(func=command('schema', 'status'))
+
+    # Static asset commands
+    p_assets = subparsers.add_parser('assets', help='Manage the built static files')
+    assets_sub = p_assets.add_subparsers(required=True, dest='assets_command')
+    assets_build = assets_sub.add_parser('build', help='Minify, hash and compress the static files into ASSETS_PATH')
+    assets_build.add_argument('--clean', help='Remove files from earlier builds', action='store_true', default=False)
+    assets_build.set_defaults(func=command('assets', 'build'))
+
+    # Static export command
+    p_export = subparsers.add_parser('export', help='Render the whole website to static files')
+    p_export.add_argument('dir', help='Directory to write the website to')
+    p_export.add_argument('--full', help='Render every page instead of only those changed since the last export', action='store_true', default=False)
+    p_export.add_argument('-j', '--jobs', help='Number of processes rendering pages', type=int, default=os.cpu_count())
+    p_export.set_defaults(func=command('export', 'run'))
+
     # Import command
     p_import = subparsers.add_parser('import', help='Import blog posts from WordPress')
     p_import.add_argument('address', help='Address of the MySQL instance hosting WordPress')
     p_import.add_argument('-p', '--port', help='MySQL port', type=int, default=3306)
     p_import.add_argument('database', help='WordPress database name')
     p_import.add_argument('user', help='WordPress database user')
-    p_import.set_defaults(func=wp_import.run)
+    p_import.add_argument('-b', '--batch', help='Number of posts to import per transaction', type=int, default=500)
+    p_import.set_defaults(func=command('wp_import', 'run'))
+
+    # Import from dump command
+    p_import_dump = subparsers.add_parser('import-dump', help='Import blog posts from a WordPress mysqldump file')
+    p_import_dump.add_argument('file', help='Path to the dump (.sql or .sql.gz)')
+    p_import_dump.add_argument('-b', '--batch', help='Number of posts to import per transaction', type=int, default=500)
+    p_import_dump.set_defaults(func=command('wp_import', 'run_dump'))
 
     # Blog posts command
     p_blog = subparsers.add_parser('posts', help='Manage blog posts')
-    p_blog.set_defaults(func=blog.list_simple)
+    p_blog.set_defaults(func=command('blog', 'list_simple'))
     blog_sub = p_blog.add_subparsers(dest='blog_command')
 
     # Blog posts list command
     blog_list = blog_sub.add_parser('list', help='List blog posts')
     blog_list.add_argument('-n', '--limit', help='Maximum number of posts to retrieve (0 for unlimited)', type=int, default=0)
     blog_list.add_argument('-r', '--reverse', help='Reverse the order of blog posts (defaults to newest first)', action='store_true', default=False)
-    blog_list.set_defaults(func=blog.list)
+    blog_list.set_defaults(func=command('blog', 'list'))
 
     # Blog posts retrieval command
     blog_get = blog_sub.add_parser('get', help='Retrieve a blog post by its ID')
@@ -53,19 +87,19 @@ def run():
     ex_group = blog_get.add_mutually_exclusive_group()
     ex_group.add_argument('--html', help='Force retrieval of post HTML (defaults to Markdown if available)', action='store_true', default=False)
     ex_group.add_argument('--force-markdown', help='If a post has no Markdown, convert it from HTML (via html2text)', action='store_true', default=False)
-    blog_get.set_defaults(func=blog.get)
+    blog_get.set_defaults(func=command('blog', 'get'))
 
     # Blog posts deletion command
     blog_delete = blog_sub.add_parser('delete', help='Delete a blog post by its ID')
     blog_delete.add_argument('id', help='Post ID', type=int)
-    blog_delete.set_defaults(func=blog.delete)
+    blog_delete.set_defaults(func=command('blog', 'delete'))
 
     # Blog posts creation command
     blog_new = blog_sub.add_parser('new', help='Create a new blog post')
     blog_new.add_argument('-a', '--authors', help='Post author(s) - pass for each author', action='append', required=True)
     blog_new.add_argument('--html', help='Write HTML directly instead of Markdown', action='store_true', default=False)
     blog_new.add_argument('title', help='Post title')
-    blog_new.set_defaults(func=blog.new)
+    blog_new.set_defaults(func=command('blog', 'new'))
 
     # Blog posts editing command
     blog_edit = blog_sub.add_parser('edit', help='Edit an existing blog post')
@@ -78,41 +112,57 @@ def run():
             'WARNING: Passing this option when a Markdown version exists will remove the Markdown version', action='store_true', default=False)
     ex_group.add_argument('--force-markdown', help='If a post has no Markdown, convert it from HTML (via html2text) before editing', action='store_true', default=False)
     blog_edit.add_argument('id', help='Post ID', type=int)
-    blog_edit.set_defaults(func=blog.edit)
+    blog_edit.set_defaults(func=command('blog', 'edit'))
+
+    # Blog posts bulk conversion commands
+    blog_summarize = blog_sub.add_parser('summarize', help='Generate home page summaries for posts that are missing one')
+    blog_summarize.add_argument('--all', help='Regenerate summaries for every post', action='store_true', default=False)
+    blog_summarize.set_defaults(func=command('blog', 'summarize_all'))
+    blog_rerender = blog_sub.add_parser('rerender', help='Regenerate the HTML of every post written in Markdown (e.g. after a Markdown upgrade)')
+    blog_rerender.set_defaults(func=command('blog', 'rerender'))
+    blog_convert = blog_sub.add_parser('convert-markdown', help='Convert the HTML of posts without Markdown (e.g. imported ones) to Markdown '+
+            '(via html2text), the HTML is kept until the post is edited')
+    blog_convert.set_defaults(func=command('blog', 'convert_markdown'))
+    for bulk in (blog_summarize, blog_rerender, blog_convert):
+        bulk.add_argument('-j', '--jobs', help='Number of processes converting posts', type=int, default=os.cpu_count())
+        bulk.add_argument('-b', '--batch', help='Number of posts to process per commit', type=int, default=100)
 
     # Book/Library command
     p_books = subparsers.add_parser('books', help='Manage the library')
-    p_books.set_defaults(func=library.simple_list)
+    p_books.set_defaults(func=command('library', 'simple_list'))
     books_sub = p_books.add_subparsers(dest='books_command')
 
     # list books
     book_list = books_sub.add_parser('list', help='List books')
     book_list.add_argument('-n', '--limit', help='Maximum number of books to retrieve (0 for unlimited)', type=int, default=0)
     book_list.add_argument('-r', '--reverse', help='Reverse the order of book (defaults to newest first)', action='store_true', default=False)
-    book_list.set_defaults(func=library.list)
+    book_list.set_defaults(func=command('library', 'list'))
 
     # Book deletion command
     book_delete = books_sub.add_parser('delete', help='Delete a book post by its ID or ISBN')
     book_delete.add_argument('id', help='Book ID or ISBN', type=int)
-    book_delete.set_defaults(func=library.delete)
+    book_delete.set_defaults(func=command('library', 'delete'))
 
     # Book creation command
     book_new = books_sub.add_parser('new', help='Add a new book to the library')
     book_new.add_argument('-lit', '--literature', action='store_true', help='Set book type to literature')
+    book_new.add_argument('-j', '--jobs', help='Number of books to look up at the same time', type=int, default=8)
+    book_new.add_argument('-b', '--batch', help='Number of books to add per commit', type=int, default=20)
+    book_new.add_argument('--offline', help='Only use previously cached Goodreads / Classify responses', action='store_true', default=False)
     book_new_sub = book_new.add_subparsers(required=True, dest='book_add_command')
     single_book = book_new_sub.add_parser('single')
     single_book.add_argument('isbn', help='ISBN(13) of the book to add')
-    single_book.set_defaults(func=library.new, list=False)
+    single_book.set_defaults(func=command('library', 'new'), list=False)
     multiple_books = book_new_sub.add_parser('list')
-    multiple_books.set_defaults(func=library.new, list=True)
+    multiple_books.set_defaults(func=command('library', 'new'), list=True)
     manual_books = book_new_sub.add_parser('manual')
-    manual_books.set_defaults(func=library.manual_add)
-    book_new.set_defaults(func=library.new, list=True)
+    manual_books.set_defaults(func=command('library', 'manual_add'))
+    book_new.set_defaults(func=command('library', 'new'), list=True)
 
     # Book retrieval command
     book_get = books_sub.add_parser('get', help='Retrieve a Book its ID or isbn')
     book_get.add_argument('id', help='Post ID')
-    book_get.set_defaults(func=library.get)
+    book_get.set_defaults(func=command('library', 'get'))
 
     # Book editing command
     book_edit = books_sub.add_parser('edit', help='Edit an existing book')
@@ -120,7 +170,17 @@ def run():
     book_edit.add_argument('-e', '--editor', nargs='?', help='Command to run as editor', default=DEFAULT_EDITOR)
     book_edit.add_argument('-t', '--type', help='Change the type of the book', type=int)
     book_edit.add_argument('-a', '--authors', action='store_true', help='Enables author editing')
-    book_edit.set_defaults(func=library.edit)
+    book_edit.set_defaults(func=command('library', 'edit'))
+
+    # Cover image commands
+    book_covers = books_sub.add_parser('covers', help='Manage the locally stored book covers')
+    covers_sub = book_covers.add_subparsers(required=True, dest='covers_command')
+    covers_sync = covers_sub.add_parser('sync', help='Download and store the covers of books that don\'t have one yet')
+    covers_sync.add_argument('-a', '--all', help='Store every book\'s cover again', action='store_true', default=False)
+    covers_sync.add_argument('-j', '--jobs', help='Number of covers to download at the same time', type=int, default=8)
+    covers_sync.add_argument('-p', '--processes', help='Number of processes resizing covers', type=int, default=os.cpu_count())
+    covers_sync.add_argument('-b', '--batch', help='Number of books to update per commit', type=int, default=50)
+    covers_sync.set_defaults(func=command('covers', 'sync'))
 
     args = parser.parse_args()
     sys.exit(args.func(args))
@@ -0,0 +1,84 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+from os import path
+
+import brotli
+
+from .. import app
+from ..assets import MANIFEST
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+def minify_css(css):
+    # Enough for our own stylesheets (which don't have strings with any of these in them)
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    # Colons in selectors can matter (a :hover isn't a:hover), in declarations they can't
+    css = re.sub(r'\{[^}]*\}', lambda block: re.sub(r'\s*:\s*', ':', block.group(0)), css)
+    return css.replace(';}', '}').strip()
+
+MINIFIERS = {
+    '.css': minify_css,
+}
+COMPRESSORS = {
+    '.gz': lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+    '.br': lambda data: brotli.compress(data, quality=11),
+}
+
+def write(dest, data):
+    os.makedirs(path.dirname(dest), exist_ok=True)
+    # Written under another name first, so nothing ever serves half a file
+    tmp = f'{dest}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, dest)
+
+def build_file(name, out_dir):
+    """ Writes the built version of a static file (and its compressed versions), returns its name """
+    with open(path.join(app.static_folder, name), 'rb') as f:
+        data = f.read()
+    base, ext = path.splitext(name)
+    if ext in MINIFIERS:
+        data = MINIFIERS[ext](data.decode('utf-8')).encode('utf-8')
+    built = f'{base}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+
+    dest = path.join(out_dir, built)
+    # Same contents as an earlier build
+    if path.exists(dest):
+        return built
+    write(dest, data)
+    sizes = [f'{len(data)} bytes']
+    for suffix, compress in COMPRESSORS.items():
+        compressed = compress(data)
+        # Not worth it for tiny or already compressed files
+        if len(compressed) < len(data):
+            write(dest + suffix, compressed)
+            sizes.append(f'{suffix[1:]} {len(compressed)}')
+    eprint(f'{name} -> {built} ({", ".join(sizes)})')
+    return built
+
+def build(args):
+    out_dir = app.config['ASSETS_PATH']
+    manifest = {}
+    for root, _, files in os.walk(app.static_folder):
+        for name in files:
+            name = path.relpath(path.join(root, name), app.static_folder).replace(os.sep, '/')
+            manifest[name] = build_file(name, out_dir)
+    write(path.join(out_dir, MANIFEST), json.dumps(manifest, indent=2).encode('utf-8'))
+
+    if args.clean:
+        # Earlier builds are kept by default, pages cached before this one may still link them
+        keep = {MANIFEST} | {built + suffix for built in manifest.values() for suffix in ('', *COMPRESSORS)}
+        for root, _, files in os.walk(out_dir):
+            for name in files:
+                name = path.relpath(path.join(root, name), out_dir).replace(os.sep, '/')
+                if name not in keep:
+                    os.remove(path.join(out_dir, name))
+                    eprint(f'Removed {name}')
+    eprint(f'Built {len(manifest)} asset(s) in {out_dir}')
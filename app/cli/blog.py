@@ -1,35 +1,30 @@
 from datetime import datetime
+import multiprocessing
 import sys
 import os
 from os import path
 import tempfile
 import subprocess
+import time
 
-from html2text import html2text
-import markdown
 import tzlocal
+from sqlalchemy import bindparam, true
 
-from .. import db, pretty_authors
+from .. import db, pretty_authors, summarize
+from ..converters import html_to_markdown, render_markdown
+from ..cache import invalidate
 from ..models import User, BlogPost
 from . import CLIError
 
 timezone = tzlocal.get_localzone()
-md = markdown.Markdown(output_format='html5')
 
 def eprint(msg):
     print(msg, file=sys.stderr)
 def pretty_time(time):
     return time.astimezone(timezone).strftime('%Y-%m-%d at %X %Z')
 def find_or_make_users(users):
-    obj_users = []
-    for name in users:
-        u = User.find_one(name)
-        if not u:
-            u = User(name=name)
-            db.session.add(u)
-        obj_users.append(u)
-    db.session.commit()
-    return obj_users
+    # Committed along with the post they belong to
+    return User.find_or_make([{'name': name} for name in users])
 def get_post(id):
     post = BlogPost.find_one(id)
     if not post:
@@ -39,7 +34,7 @@ def extension(is_html):
     return '.html' if is_html else '.md'
 
 def list(args):
-    query = BlogPost.query\
+    query = BlogPost.list_query()\
             .order_by(BlogPost.edited.asc() if args.reverse else BlogPost.edited.desc())
     if args.limit != 0:
         query = query.limit(args.limit)
@@ -67,7 +62,7 @@ def get(args):
         content = post.markdown
     elif args.force_markdown:
         eprint('Converting HTML to Markdown...')
-        content = html2text(post.html)
+        content = html_to_markdown(post.html)
     else:
         eprint('Warning: Markdown unavailable, showing HTML')
         content = post.html
@@ -78,6 +73,7 @@ def delete(args):
     post = get_post(args.id)
     db.session.delete(post)
     db.session.commit()
+    invalidate('posts', f'post:{post.id}')
     eprint(f'Post #{post.id} deleted')
 
 def new(args):
@@ -106,10 +102,12 @@ def new(args):
         post.html = content
     else:
         post.markdown = content
-        post.html = md.convert(content)
+        post.html = render_markdown(content)
+    post.summary = summarize(post.html)
 
     db.session.add(post)
     db.session.commit()
+    invalidate('posts')
     eprint(f'Created post #{post.id}')
 
 def edit(args):
@@ -132,7 +130,7 @@ def edit(args):
             content = post.markdown
         elif args.force_markdown:
             eprint('Converting HTML to Markdown...')
-            content = html2text(post.html)
+            content = html_to_markdown(post.html)
         else:
             is_html = True
             eprint('Warning: Markdown unavailable, editing HTML')
@@ -165,9 +163,70 @@ def edit(args):
             post.html = content
         else:
             post.markdown = content
-            post.html = md.convert(content)
+            post.html = render_markdown(content)
+        post.summary = summarize(post.html)
     post.edited = datetime.now(tz=timezone)
 
     db.session.add(post)
     db.session.commit()
+    invalidate('posts', f'post:{post.id}')
     eprint(f'Edited post #{post.id}')
+
+# Bulk conversions, run in a pool of processes - each takes an (id, content) row of a post and
+# returns the updated columns
+def _render_markdown(row):
+    id, content = row
+    html = render_markdown(content)
+    return {'_id': id, 'html': html, 'summary': summarize(html)}
+def _markdown_from_html(row):
+    id, html = row
+    return {'_id': id, 'markdown': html_to_markdown(html)}
+def _summarize(row):
+    id, html = row
+    return {'_id': id, 'summary': summarize(html)}
+
+def bulk_convert(args, column, where, convert):
+    """ Updates every post matching where with convert((id, column)), returns the number of posts """
+    table = BlogPost.__table__
+    update = table.update().where(table.c.id == bindparam('_id'))
+    def write(results):
+        db.session.execute(update, results)
+        db.session.commit()
+        return len(results)
+
+    count, last_id, pending = 0, 0, None
+    start = time.perf_counter()
+    # fork so the workers have the converters without importing the app again
+    with multiprocessing.get_context('fork').Pool(args.jobs) as pool:
+        while True:
+            rows = db.session.query(BlogPost.id, column)\
+                    .filter(where, BlogPost.id > last_id)\
+                    .order_by(BlogPost.id).limit(args.batch).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            # Convert this batch while the previous one is written
+            job = pool.map_async(convert, rows)
+            if pending:
+                count += write(pending.get())
+            pending = job
+        if pending:
+            count += write(pending.get())
+
+    elapsed = time.perf_counter() - start
+    eprint(f'Converted {count} post(s) in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} posts/sec)')
+    return count
+
+def summarize_all(args):
+    where = true() if args.all else BlogPost.summary.is_(None)
+    if bulk_convert(args, BlogPost.html, where, _summarize):
+        invalidate('posts')
+
+def rerender(args):
+    if bulk_convert(args, BlogPost.markdown, BlogPost.markdown.isnot(None), _render_markdown):
+        invalidate('posts', 'post-bodies')
+
+def convert_markdown(args):
+    # Doesn't change what's shown on the website until the post is edited, so no invalidation
+    bulk_convert(args, BlogPost.html, BlogPost.markdown.is_(None), _markdown_from_html)
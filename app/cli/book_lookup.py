@@ -0,0 +1,177 @@
+import json
+import requests
+import sys
+import threading
+import time
+import logging
+
+from bs4 import BeautifulSoup
+from difflib import get_close_matches
+from goodreads import client
+from goodreads.book import GoodreadsBook
+from goodreads.request import GoodreadsRequestException
+from os import environ
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+from xml.etree import ElementTree as ET
+from xml.parsers.expat import ExpatError
+
+from .covers import download
+from .lookup_cache import LookupCache, NotCached
+
+# Looking books up on Goodreads / OCLC Classify, only imported by `books new` so the other
+# commands don't have to load (and configure) the HTTP clients
+
+# Goodreads Client setup
+api_key = environ['GR_KEY']
+api_secret = environ['GR_SECRET']
+gc = client.GoodreadsClient(api_key, api_secret)
+# Overridable so ingestion can be run against a local stub server
+gc.base_url = environ.get('GR_URL', gc.base_url)
+classify_url = environ.get('CLASSIFY_URL', 'http://classify.oclc.org/classify2/Classify')
+
+retries = Retry(total=5, backoff_factor=2, status_forcelist=(429, 500, 502, 503, 504))
+reqs = requests.Session()
+reqs.mount('http://', HTTPAdapter(max_retries=retries))
+reqs.mount('https://', HTTPAdapter(max_retries=retries))
+
+class RateLimiter:
+    """ Spaces out requests to each host by at least interval seconds, across threads """
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = {}
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        time.sleep(start - now)
+
+# Seconds between requests to the same host (Goodreads allows one request per second)
+limiter = RateLimiter(float(environ.get('LOOKUP_INTERVAL', 1)))
+
+# Goodreads / Classify responses saved on disk (see LookupCache, the `lookups` Docker volume), TTLs
+# are in seconds
+lookups = LookupCache(
+    environ.get('LOOKUP_CACHE', '/opt/lookups/lookups.sqlite'),
+    ttl=int(environ.get('LOOKUP_CACHE_TTL', 30 * 24 * 3600)),
+    failure_ttl=int(environ.get('LOOKUP_CACHE_FAILURE_TTL', 24 * 3600)),
+)
+
+def goodreads_book(isbn, attempts=3):
+    def fetch():
+        # The Goodreads client doesn't use our session, so retry dropped connections here
+        for attempt in range(attempts):
+            limiter.wait(gc.base_url)
+            try:
+                return gc.request('book/isbn', {'isbn': isbn})['book']
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    book_dict = lookups.fetch('goodreads', isbn, fetch, failures=(GoodreadsRequestException,))
+    return GoodreadsBook(book_dict, gc)
+
+def eprint(msg):
+    tqdm.write(msg, file=sys.stderr)
+
+def _get_xml(paramValue, paramType='isbn', verbose=False):
+    """Classify docs: http://classify.oclc.org/classify2/api_docs/index.html """
+    def fetch():
+        params = {paramType:paramValue.encode('utf-8'),'summary':True}
+        limiter.wait(classify_url)
+        r = reqs.get(classify_url, params=params)
+        if verbose: print(r.url)
+        return r.text
+
+    xdoc = ET.fromstring(lookups.fetch('classify', f'{paramType}={paramValue}', fetch))
+    return xdoc
+
+def _get_closest_index(match, choices):
+    return choices.index(get_close_matches(match, choices, n=1)[0])
+
+def get_ddc(isbn, book, verbose=False):
+    ddc = None
+    try:
+        # Get xml + namesapce + code
+        xdoc = _get_xml(isbn, verbose=verbose)
+        ns = xdoc.tag.split('}')[0]+'}'
+        respCode = xdoc.find(f'.//{ns}response').get('code')
+
+        # Multiwork response - automatically select work based on title
+        if respCode =='4':
+            works = xdoc.findall(f'.//{ns}work')
+            # Automatically select right book
+            num = _get_closest_index(book.title, [x.get('title') for x in works])
+
+            if verbose:
+                eprint('Multiple Works: ')
+                eprint('\n'.join([f'{i}) {w.get("title")}' for i,w in enumerate(works)]))
+                eprint(f'Goodreads Title: {book.title}')
+                eprint(f'Automatically selected {num}')
+
+            # Get single work response
+            xdoc = _get_xml(works[num].get('owi'), 'owi')
+            respCode = xdoc.find(f'.//{ns}response').get('code')
+
+        # single work response
+        if respCode == '0' or respCode == '2':
+            ddc = xdoc.find(f'.//{ns}recommendations/{ns}ddc/{ns}mostPopular').get('sfa')
+        return ddc
+    except NotCached:
+        # Offline, so we don't know whether there's a DDC - fail the book rather than add it without
+        raise
+    except Exception as e:
+        logging.error(e)
+        return ddc
+
+def scrape_cover(link):
+    limiter.wait(link)
+    r = reqs.get(link)
+    soup = BeautifulSoup(r.text, 'html.parser')
+    img = soup.find(id='coverImage')
+    return img.get('src') if img else None
+
+def fetch_book(isbn, verbose=False):
+    """ Looks up everything needed to add a book (runs on a worker thread, so no db access) """
+    fetched = {'isbn': isbn, 'status': '', 'book': None}
+    try:
+        book = goodreads_book(isbn)
+        if verbose:
+            print(json.dumps(book._book_dict['authors'], indent=4))
+
+        ddc = get_ddc(isbn, book, verbose=verbose)
+        if not ddc:
+            fetched['status'] += '> ATTENTION: No DDC '
+            ddc = 'XXX.XX'
+
+        # Select image
+        image_url = book.image_url
+        if 'nophoto' in book.image_url:
+            image_url = lookups.fetch('cover', book.link, lambda: scrape_cover(book.link))
+            if not image_url:
+                image_url = book.image_url
+                fetched['status'] += '> ATTENTION: No IMG'
+
+        # Stored (in the process pool) when the book is added
+        image = None if lookups.offline else download(image_url)
+        if not image and not lookups.offline:
+            fetched['status'] += '> ATTENTION: Cover not downloaded '
+
+        fetched.update(book=book, ddc=ddc, image_url=image_url, image=image)
+
+    # GoodreadsRequestException
+    except GoodreadsRequestException as e:
+        e = ' '.join(e.__str__())
+        fetched['status'] = f'> FAILURE: <GoodreadsRequestException> {e}'
+    except ExpatError as e:
+        fetched['status'] = f'> FAILURE: {type(e)} {e} [check Goodread keys in environ file]'
+    except Exception as e:
+        fetched['status'] = f'> FAILURE: {type(e)} {e}'
+    return fetched
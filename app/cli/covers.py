@@ -0,0 +1,119 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import bindparam
+from urllib3.util.retry import Retry
+
+from .. import app, db
+from ..cache import invalidate
+from ..models import Book
+
+# Book covers are downloaded once, resized and kept in COVERS_PATH as JPEGs named after a hash of
+# the original image, which the website serves from /covers/ with far-future caching (instead of
+# every visitor's browser fetching full size covers from Goodreads).
+
+# Each size is scaled to fit within (width, height), twice what the pages show for high DPI screens
+SIZES = {
+    'thumb': (160, 240),
+    'detail': (480, 720),
+}
+
+retries = Retry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504))
+session = requests.Session()
+session.mount('http://', HTTPAdapter(max_retries=retries))
+session.mount('https://', HTTPAdapter(max_retries=retries))
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+def pool(jobs=None):
+    # fork so the workers don't import the app again. Best made before opening any database
+    # connections or starting threads, so the workers don't inherit them
+    return multiprocessing.get_context('fork').Pool(jobs)
+
+def download(url):
+    """ The image at url (bytes), None if it couldn't be downloaded """
+    try:
+        r = session.get(url, timeout=30)
+        r.raise_for_status()
+        return r.content
+    except requests.RequestException:
+        return None
+
+def store(image):
+    """ Saves each of SIZES of an image (bytes), returns its hash (None if it isn't an image).
+    Runs in the process pool """
+    if not image:
+        return None
+    cover = hashlib.sha256(image).hexdigest()[:32]
+    original = None
+    try:
+        for size, box in SIZES.items():
+            dest = os.path.join(app.config['COVERS_PATH'], Book.cover_file(cover, size))
+            # Already have this image (e.g. Goodreads' "no photo" placeholder)
+            if os.path.exists(dest):
+                continue
+            if not original:
+                original = Image.open(io.BytesIO(image)).convert('RGB')
+            resized = original.copy()
+            resized.thumbnail(box, Image.LANCZOS)
+
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            # Written under another name first, so nothing ever serves half a file
+            tmp = f'{dest}.{os.getpid()}.tmp'
+            resized.save(tmp, 'JPEG', quality=85, optimize=True, progressive=True)
+            os.replace(tmp, dest)
+    except (OSError, Image.DecompressionBombError):
+        return None
+    return cover
+
+def sync(args):
+    """ Downloads and stores the covers of books that don't have one yet (or all of them) """
+    with pool(args.processes) as processes, ThreadPoolExecutor(max_workers=args.jobs) as downloads:
+        query = db.session.query(Book.id, Book.image_url).filter(Book.image_url.isnot(None))
+        if not args.all:
+            query = query.filter(Book.cover.is_(None))
+        books = query.order_by(Book.id).all()
+
+        table = Book.__table__
+        update = table.update().where(table.c.id == bindparam('_id'))
+        stored, failed = 0, []
+        def write(batch, job):
+            nonlocal stored
+            rows = []
+            for (id, url), cover in zip(batch, job.get()):
+                if cover:
+                    rows.append({'_id': id, 'cover': cover})
+                else:
+                    failed.append((id, url))
+            if rows:
+                db.session.execute(update, rows)
+                # Commits too
+                invalidate('library', *(f"book:{row['_id']}" for row in rows))
+            stored += len(rows)
+
+        start = time.perf_counter()
+        pending = None
+        for i in range(0, len(books), args.batch):
+            batch = books[i:i + args.batch]
+            images = downloads.map(download, [url for _, url in batch])
+            # Resize this batch while the next one downloads
+            job = processes.map_async(store, images)
+            if pending:
+                write(*pending)
+            pending = batch, job
+        if pending:
+            write(*pending)
+
+    elapsed = time.perf_counter() - start
+    for id, url in failed:
+        eprint(f'#{id}\t> No cover from {url}')
+    eprint(f'Stored {stored} cover(s) in {elapsed:.1f}s ({stored / elapsed if elapsed else 0:.1f} covers/sec)')
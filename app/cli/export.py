@@ -0,0 +1,162 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from os import path
+from urllib.parse import urlsplit
+
+from flask import url_for
+
+from .. import app, db, templates_version
+from ..cache import tag_versions
+from ..models import BlogPost, Book
+from . import CLIError
+
+STATE_FILE = '.export.json'
+# Same as the home() and library() defaults, so the exported pages line up with their links
+POSTS_PER_PAGE = 10
+BOOKS_PER_PAGE = 20
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+def page_file(out_dir, url):
+    """ Where the page for url is written - /posts/1 -> posts/1/index.html, and a query string
+    is kept in the file name (/?page=2&after=5 -> index.html?page=2&after=5) """
+    parts = urlsplit(url)
+    name = 'index.html' + (f'?{parts.query}' if parts.query else '')
+    return path.join(out_dir, parts.path.strip('/'), name)
+
+def page_urls(endpoint, query, per_page):
+    """ URLs of every page of a list view, following the same keyset cursors as its links """
+    urls = [url_for(endpoint)]
+    ids = [row[0] for row in query]
+    for page, i in enumerate(range(per_page, len(ids), per_page), 2):
+        urls.append(url_for(endpoint, page=page, after=ids[i-1]))
+    return urls
+
+def _init_worker():
+    # Connections can't be shared with the parent process
+    db.engine.dispose()
+
+def _render(job):
+    out_dir, url = job
+    response = app.test_client().get(url)
+    if response.status_code == 200:
+        dest = page_file(out_dir, url)
+        os.makedirs(path.dirname(dest), exist_ok=True)
+        with open(dest, 'wb') as f:
+            f.write(response.get_data())
+    return url, response.status_code
+
+def copy_covers(out_dir):
+    """ Copies the stored book covers the export doesn't have yet (a cover's file never changes) """
+    if not path.isdir(app.config['COVERS_PATH']):
+        return
+    def copy_new(src, dest):
+        if not path.exists(dest):
+            shutil.copy2(src, dest)
+    shutil.copytree(app.config['COVERS_PATH'], path.join(out_dir, 'covers'), dirs_exist_ok=True,
+            copy_function=copy_new, ignore=shutil.ignore_patterns('*.tmp'))
+
+def remove_pages(out_dir, urls):
+    for url in urls:
+        page = page_file(out_dir, url)
+        try:
+            os.remove(page)
+            # Clean up the directory of e.g. a deleted post, unless something else is in there
+            os.rmdir(path.dirname(page))
+        except OSError:
+            pass
+
+def run(args):
+    out_dir = path.abspath(args.dir)
+    state_path = path.join(out_dir, STATE_FILE)
+    previous = {}
+    if path.exists(state_path):
+        with open(state_path) as f:
+            previous = json.load(f)
+    # Everything is rendered directly, caching pages here would only waste memory
+    app.config['PAGE_CACHE'] = False
+
+    with app.test_request_context():
+        templates, _ = templates_version()
+        # Every page is built from the templates, so if they changed start from scratch
+        rebuild = args.full or previous.get('templates') != templates
+        state = {} if rebuild else dict(previous)
+
+        posts = {str(id): edited.timestamp() for id, edited in
+                db.session.query(BlogPost.id, BlogPost.edited)}
+        old_posts = state.get('posts', {})
+        # Bumped by e.g. `posts rerender` and `posts summarize`, which change pages without
+        # changing when the posts were edited
+        post_tags = tag_versions(['posts', 'post-bodies'])
+        old_tags = state.get('post_tags', {})
+        if old_tags.get('post-bodies') != post_tags['post-bodies']:
+            changed_posts = list(posts)
+        else:
+            changed_posts = [id for id, edited in posts.items() if old_posts.get(id) != edited]
+        deleted_posts = [id for id in previous.get('posts', {}) if id not in posts]
+
+        library = tag_versions(['library'])['library']
+        books = [str(id) for id, in db.session.query(Book.id)]
+
+        urls, stale = [], []
+        if rebuild:
+            urls += [url_for(rule.endpoint) for rule in app.url_map.iter_rules()
+                    if not rule.arguments and 'GET' in rule.methods
+                    and rule.endpoint not in ('static', 'home', 'library')
+                    # e.g. /_internal/pool, which would otherwise be published
+                    and not getattr(app.view_functions[rule.endpoint], 'internal', False)]
+        if rebuild or changed_posts or deleted_posts or old_tags.get('posts') != post_tags['posts']:
+            # Cursors in the page URLs move whenever posts are added or removed
+            home = page_urls('home', db.session.query(BlogPost.id)
+                    .order_by(BlogPost.time.desc(), BlogPost.id.desc()), POSTS_PER_PAGE)
+            stale += [url for url in previous.get('home', []) if url not in home]
+            urls += home
+            state['home'] = home
+        if rebuild or state.get('library') != library:
+            pages = page_urls('library', db.session.query(Book.id).order_by(Book.id), BOOKS_PER_PAGE)
+            stale += [url for url in previous.get('library_pages', []) if url not in pages]
+            stale += [url_for('book', id=id) for id in previous.get('books', []) if id not in books]
+            urls += pages + [url_for('book', id=id) for id in books]
+            state['library_pages'] = pages
+        post_urls = {url_for('post', id=id): id for id in changed_posts}
+        urls += post_urls
+        stale += [url_for('post', id=id) for id in deleted_posts]
+
+    os.makedirs(out_dir, exist_ok=True)
+    shutil.copytree(app.static_folder, path.join(out_dir, 'static'), dirs_exist_ok=True)
+    copy_covers(out_dir)
+    if app.config['ASSETS'] and path.isdir(app.config['ASSETS_PATH']):
+        # Including the gzip / brotli versions, for nginx's gzip_static / brotli_static
+        shutil.copytree(app.config['ASSETS_PATH'], path.join(out_dir, 'assets'), dirs_exist_ok=True,
+                ignore=shutil.ignore_patterns('*.tmp', 'manifest.json'))
+    remove_pages(out_dir, stale)
+
+    start = time.perf_counter()
+    failed = []
+    # fork so the workers inherit the configured app instead of importing it again
+    with multiprocessing.get_context('fork').Pool(args.jobs, initializer=_init_worker) as pool:
+        for url, status in pool.imap_unordered(_render, [(out_dir, url) for url in urls], chunksize=16):
+            if status != 200:
+                failed.append(url)
+                eprint(f'{url}\t> HTTP {status}')
+    elapsed = time.perf_counter() - start
+
+    # Leave what failed out of the state so the next export tries it again: posts on their own,
+    # anything else by rendering everything
+    failed_posts = {post_urls[url] for url in failed if url in post_urls}
+    posts = {id: edited for id, edited in posts.items() if id not in failed_posts}
+    if any(url not in post_urls for url in failed):
+        templates = None
+    state.update(templates=templates, posts=posts, post_tags=post_tags, library=library, books=books)
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+
+    eprint(f'Exported {len(urls) - len(failed)} page(s), removed {len(stale)} in {elapsed:.1f}s '
+            f'({len(urls) / elapsed if elapsed else 0:.0f} pages/sec)')
+    if failed:
+        raise CLIError(f'{len(failed)} page(s) failed to render')
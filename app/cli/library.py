@@ -1,58 +1,92 @@
 import json
 import os
-import logging
-import requests
+import re
 import subprocess
 import sys
 import tempfile
 
-from bs4 import BeautifulSoup
-from difflib import get_close_matches
-from goodreads import client
-from goodreads.request import GoodreadsRequestException
-from os import environ
-from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sqlalchemy import or_
-from tqdm import tqdm
-from urllib3.util.retry import Retry
-from xml.etree import ElementTree as ET
-from xml.parsers.expat import ExpatError
+from sqlalchemy.exc import IntegrityError
 
 from . import CLIError
 from .. import db, pretty_authors
+from ..cache import invalidate
 from ..models import BookAuthor, Book, BookTypes
 
-# Goodreads Client setup
-api_key = environ['GR_KEY']
-api_secret = environ['GR_SECRET']
-gc = client.GoodreadsClient(api_key, api_secret)
-
-reqs = requests.Session()
-reqs.mount = HTTPAdapter(max_retries=Retry(connect=5, backoff_factor=2))
-
 def table_keys(table):
     return [key for key in table.__dict__.keys() if key[0]!='_' and key!='id']
 
 def eprint(msg):
-    tqdm.write(msg, file=sys.stderr)
+    print(msg, file=sys.stderr)
 
 def remove_empty_vals(d):
     return {key:d[key] for key in d if not d[key] in ('',None)}
 
 # author is of type: list of dict
 def find_or_make_authors(authors):
-    obj_authors = []
-    for author in authors:
-        db_author = BookAuthor.find_one(author.get('name', None))
-        if not db_author:
-            db_author = BookAuthor(
-                name=author.get('name',None),
-                gr_link=author.get('link',None) or author.get('gr_link',None),
-            )
-            db.session.add(db_author)
-        obj_authors.append(db_author)
-    db.session.commit()
-    return obj_authors
+    # Committed along with the book(s) they belong to
+    return BookAuthor.find_or_make([{
+        'name': author.get('name', None),
+        'gr_link': author.get('link', None) or author.get('gr_link', None),
+    } for author in authors])
+
+class CallNumbers:
+    """ Hands out free call numbers: the prefix itself (e.g. "005.133 STR"), then "<prefix> (1)",
+    "<prefix> (2)" and so on. The numbers already taken under a prefix are read with one query the
+    first time it's needed (or for many prefixes at once with load()) and kept, so a batch of books
+    with the same prefix doesn't ask the database again for each one """
+    SUFFIX = re.compile(r' \((\d+)\)$')
+
+    def __init__(self):
+        self.taken = {}
+
+    @classmethod
+    def split(cls, callnumber):
+        """ "005.133 STR (2)" -> ("005.133 STR", 2), with 0 for the prefix on its own """
+        suffix = cls.SUFFIX.search(callnumber)
+        if not suffix:
+            return callnumber, 0
+        return callnumber[:suffix.start()], int(suffix.group(1))
+
+    def load(self, prefixes):
+        """ Reads which numbers are taken under each of the prefixes not seen yet, in one query """
+        prefixes = {p for p in prefixes if p not in self.taken}
+        if not prefixes:
+            return
+        for prefix in prefixes:
+            self.taken[prefix] = set()
+        # "<prefix> (n)" sorts between "<prefix> (" and "<prefix> )", so each of these is a range
+        # scan of the callnumber index
+        query = db.session.query(Book.callnumber).filter(or_(*(
+            or_(Book.callnumber == p, Book.callnumber.between(p + ' (', p + ' )')) for p in prefixes)))
+        for callnumber, in query:
+            prefix, n = self.split(callnumber)
+            if prefix in self.taken:
+                self.taken[prefix].add(n)
+
+    def allocate(self, prefix):
+        """ Takes the first free call number under prefix """
+        self.load([prefix])
+        taken = self.taken[prefix]
+        n = 0
+        while n in taken:
+            n += 1
+        taken.add(n)
+        return f'{prefix} ({n})' if n else prefix
+
+    def release(self, callnumber):
+        """ Gives back a call number that wasn't used after all """
+        prefix, n = self.split(callnumber)
+        self.taken.get(prefix, set()).discard(n)
+
+def callnumber_prefix(fetched):
+    """ Dewey decimal number and the first three letters of the first author's surname (None
+    without an author) """
+    book = fetched['book']
+    if not book.authors:
+        return None
+    return fetched['ddc'][:7] +' '+ book.authors[0].name.split()[-1][:3].upper()
 
 def get_book(id):
     book = Book.query.filter(or_(
@@ -66,12 +100,12 @@ def get_book(id):
     return book
 
 def list(args):
-    query = Book.query\
+    query = Book.list_query()\
             .order_by(Book.id.asc() if args.reverse else Book.id.desc())
     if args.limit != 0:
         query = query.limit(args.limit)
     for book in query:
-        print(f'#{book.id}: "{book.title}"')# by {pretty_authors(book)} isbn: {book.isbn}')
+        print(f'#{book.id}: "{book.title}" by {pretty_authors(book)} isbn: {book.isbn}')
 
 def simple_list(args):
     args.limit = 10
@@ -82,6 +116,7 @@ def delete(args):
     book = get_book(id=args.id)
     db.session.delete(book)
     db.session.commit()
+    invalidate('library', f'book:{book.id}')
     eprint(f'Book #{book.id} deleted')
 
 def get(args):
@@ -116,6 +151,7 @@ def edit(args):
         # bulk update other fields
         books = Book.query.filter(Book.id==book.id).update(updated_book)
         db.session.commit()
+        invalidate('library', f'book:{book.id}')
         eprint(' > Updated #{book.id}')
 
     except Exception as e:
@@ -152,15 +188,38 @@ def edit_loop(book_dict, editor):
         return book_dict
 
 def new(args):
-    msgs, isbns = [], []
+    # Only needed here, and slow to import
+    from tqdm import tqdm
+    from .book_lookup import fetch_book, lookups
+    from . import covers
+    processes = covers.pool()
+
     if args.list: isbns = sys.stdin.read().splitlines()
     else: isbns = [args.isbn]
-
-    for isbn in tqdm(isbns):
-        if Book.query.filter((Book.isbn==isbn) | (Book.isbn13==isbn)).first():
+    lookups.offline = args.offline
+
+    # Check all of the ISBNs against the db at once
+    existing = set()
+    for isbn, isbn13 in db.session.query(Book.isbn, Book.isbn13)\
+            .filter(Book.isbn.in_(isbns) | Book.isbn13.in_(isbns)):
+        existing.update((isbn, isbn13))
+    for isbn in isbns:
+        if isbn in existing:
             eprint(f'{isbn}\t> ISBN already in db')
-        else:
-            msgs.append(generate_book(isbn, args.literature, verbose=args.verbose))
+    isbns = [isbn for isbn in dict.fromkeys(isbns) if isbn not in existing]
+
+    # Lookups run in parallel, everything touching the db stays on this thread
+    msgs, fetched = [], []
+    callnumbers = CallNumbers()
+    with processes, ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        fetches = [pool.submit(fetch_book, isbn, verbose=args.verbose) for isbn in isbns]
+        for fetch in tqdm(as_completed(fetches), total=len(fetches)):
+            fetched.append(fetch.result())
+            if len(fetched) >= args.batch:
+                msgs += add_books(fetched, callnumbers, processes, args.literature)
+                fetched = []
+        msgs += add_books(fetched, callnumbers, processes, args.literature)
+    invalidate('library')
 
     msgs = sorted(msgs, key=lambda m: m['status'])
     eprint("\n".join(map(lambda m: f"{m['isbn']}\t{m['status']}", msgs)))
@@ -185,118 +244,90 @@ def manual_add(args):
 
         db.session.add(db_book)
         db.session.commit()
+        invalidate('library')
         print(f'> ADDED as #{db_book.id} ')
     except Exception as e:
         print(f'> ERROR: {e}')
 
-def _get_xml(paramValue, paramType='isbn', verbose=False):
-    """Classify docs: http://classify.oclc.org/classify2/api_docs/index.html """
-    base = 'http://classify.oclc.org/classify2/Classify?'
-
-    params = {paramType:paramValue.encode('utf-8'),'summary':True}
-    r = reqs.get(base, params=params)
-    if verbose: print(r.url)
-    xdoc = ET.fromstring(r.text)
-    return xdoc
-
-def _get_closest_index(match, choices):
-    return choices.index(get_close_matches(match, choices, n=1)[0])
-
-def get_ddc(isbn, book, verbose=False):
-    ddc = None
-    try:
-        # Get xml + namesapce + code
-        xdoc = _get_xml(isbn, verbose=verbose)
-        ns = xdoc.tag.split('}')[0]+'}'
-        respCode = xdoc.find(f'.//{ns}response').get('code')
-
-        # Multiwork response - automatically select work based on title
-        if respCode =='4':
-            works = xdoc.findall(f'.//{ns}work')
-            # Automatically select right book
-            num = _get_closest_index(book.title, [x.get('title') for x in works])
-
-            if verbose:
-                eprint('Multiple Works: ')
-                eprint('\n'.join([f'{i}) {w.get("title")}' for i,w in enumerate(works)]))
-                eprint(f'Goodreads Title: {book.title}')
-                eprint(f'Automatically selected {num}')
-
-            # Get single work response
-            xdoc = _get_xml(works[num].get('owi'), 'owi')
-            respCode = xdoc.find(f'.//{ns}response').get('code')
-
-        # single work response
-        if respCode == '0' or respCode == '2':
-            ddc = xdoc.find(f'.//{ns}recommendations/{ns}ddc/{ns}mostPopular').get('sfa')
-        return ddc
-    except Exception as e:
-        logging.error(e)
-        return ddc
-
-def generate_book(isbn, lit, verbose=False):
-    status = ''
-    try:
-        book = gc.book(isbn=isbn)
-        if verbose:
-            print(json.dumps(book._book_dict['authors'], indent=4))
-        authors = find_or_make_authors([a._author_dict for a in book.authors])
-
-        ddc = get_ddc(isbn, book, verbose=verbose)
-        if not ddc:
-            status += '> ATTENTION: No DDC '
-            ddc = 'XXX.XX'
-        base_cn = ddc[:7] +' '+ book.authors[0].name.split()[-1][:3].upper()
-        cn = base_cn
-        i = 1
-        while Book.query.filter_by(callnumber=cn).first():
-            cn = base_cn + f' ({i})'
-            i += 1
-
-        # Select image
-        image_url = book.image_url
-        if 'nophoto' in book.image_url:
-            r = reqs.get(book.link)
-            soup = BeautifulSoup(r.text, 'html.parser')
-            img = soup.find(id='coverImage')
-            if img:
-                image_url = img.get('src')
-            else:
-                status += '> ATTENTION: No IMG'
-
-        db_book = Book(
-            title=book.title,
-            callnumber=cn,
-            isbn=book.isbn,
-            isbn13=book.isbn13,
-            # TODO update image search
-            image_url=image_url,
-            publisher=book.publisher,
-            description=book.description,
-            rating=book.average_rating,
-            num_pages=book.num_pages,
-            authors=authors,
-        )
-
-        if lit:
-            db_book.type = BookTypes.literature
-
-        db.session.add(db_book)
-
+def add_books(batch, callnumbers, processes, lit):
+    """ Adds a batch of fetched books and commits them, returns their status messages """
+    from .covers import store
+    # Covers are resized in the process pool
+    for fetched, cover in zip(batch, processes.map(store, [f.get('image') for f in batch])):
+        fetched['cover'] = cover
+
+    books = [fetched['book'] for fetched in batch if fetched['book']]
+    # Every author and call number prefix in the batch is looked up at once
+    rows = [a._author_dict for book in books for a in book.authors]
+    authors = dict(zip((row['name'] for row in rows), find_or_make_authors(rows)))
+    callnumbers.load(filter(None, (callnumber_prefix(f) for f in batch if f['book'])))
+
+    msgs, added = [], []
+    for fetched in batch:
+        msg, db_book = make_book(fetched, callnumbers, authors, lit)
+        msgs.append(msg)
+        if db_book:
+            added.append((msg, db_book))
+    save_books(added)
+    return msgs
+
+# Call numbers to try before giving up on a book, when another `books new` took the one allocated
+CALLNUMBER_ATTEMPTS = 5
+
+def make_book(fetched, callnumbers, authors, lit):
+    """ Adds a fetched book to the session (with its authors from authors, a map of names to
+    BookAuthors), returns its status message and the book (if any) """
+    msg = {'isbn': fetched['isbn'], 'status': fetched['status']}
+    book = fetched['book']
+    if not book:
+        return msg, None
+
+    prefix = callnumber_prefix(fetched)
+    if not prefix:
+        msg['status'] = '> COMMIT FAILURE: no authors to make a call number from '
+        return msg, None
+    for attempt in range(1, CALLNUMBER_ATTEMPTS + 1):
+        cn = callnumbers.allocate(prefix)
         try:
-            db.session.commit()
-            status += f'> ADDED as #{db_book.id:02} '
+            # A savepoint, so a bad book doesn't take the rest of its batch down with it. It's
+            # flushed at the end, so a call number someone else has taken since fails here
+            with db.session.begin_nested():
+                db_book = Book(
+                    title=book.title,
+                    callnumber=cn,
+                    isbn=book.isbn,
+                    isbn13=book.isbn13,
+                    # TODO update image search
+                    image_url=fetched['image_url'],
+                    cover=fetched['cover'],
+                    publisher=book.publisher,
+                    description=book.description,
+                    rating=book.average_rating,
+                    num_pages=book.num_pages,
+                    authors=[authors[a._author_dict['name']] for a in book.authors],
+                )
+
+                if lit:
+                    db_book.type = BookTypes.literature
+
+                db.session.add(db_book)
+            return msg, db_book
         except Exception as e:
-            db.session.rollback()
-            status = f'> COMMIT FAILURE: {e} '
-
-    # GoodreadsRequestException
-    except GoodreadsRequestException as e:
-        e = ' '.join(e.__str__())
-        status = f'> FAILURE: <GoodreadsRequestException> {e}'
-    except ExpatError as e:
-        status = f'> FAILURE: {type(e)} {e} [check Goodread keys in environ file]'
+            # The taken call number stays allocated, so the next attempt gets the one after it
+            if isinstance(e, IntegrityError) and 'callnumber' in str(e.orig) \
+                    and attempt < CALLNUMBER_ATTEMPTS:
+                continue
+            callnumbers.release(cn)
+            msg['status'] = f'> COMMIT FAILURE: {e} '
+            return msg, None
+
+def save_books(batch):
+    """ Commits a batch of books made by make_book() """
+    try:
+        db.session.commit()
+        for msg, db_book in batch:
+            msg['status'] += f'> ADDED as #{db_book.id:02} '
     except Exception as e:
-        status = f'> FAILURE: {type(e)} {e}'
-    finally:
-        return {'isbn':isbn, 'status': status}
+        db.session.rollback()
+        for msg, _ in batch:
+            msg['status'] = f'> COMMIT FAILURE: {e} '
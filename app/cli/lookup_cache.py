@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+class CachedFailure(Exception):
+    pass
+
+class NotCached(Exception):
+    pass
+
+class LookupCache:
+    """ Responses from Goodreads / OCLC Classify kept on disk, so re-running an import (or retrying
+    a failed one) doesn't have to ask for the same books again. Entries are compressed JSON keyed
+    by a hash of what was looked up, failed lookups are remembered for less time than successful
+    ones. In offline mode anything that isn't cached fails instead of going to the network. """
+
+    def __init__(self, path, ttl, failure_ttl, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.offline = offline
+        self._local = threading.local()
+
+    def _conn(self):
+        # Lookups happen on worker threads and sqlite3 connections can't be shared between them
+        if not hasattr(self._local, 'conn'):
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._local.conn = sqlite3.connect(self.path, timeout=10)
+            self._local.conn.execute('CREATE TABLE IF NOT EXISTS responses '
+                    '(hash TEXT PRIMARY KEY, kind TEXT, fetched REAL, ok INTEGER, body BLOB)')
+        return self._local.conn
+
+    @staticmethod
+    def _hash(kind, key):
+        return hashlib.sha256(f'{kind}:{key}'.encode('utf-8')).hexdigest()
+
+    def _store(self, digest, kind, ok, value):
+        body = zlib.compress(json.dumps(value).encode('utf-8'))
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                    (digest, kind, time.time(), ok, body))
+
+    def fetch(self, kind, key, fetch, failures=()):
+        """ Returns fetch()'s (JSON serializable) result for key, from the cache if possible.
+        Exceptions listed in failures mean the lookup itself failed (e.g. unknown ISBN) and are
+        cached too, they're raised again as CachedFailure """
+        digest = self._hash(kind, key)
+        row = self._conn().execute('SELECT fetched, ok, body FROM responses WHERE hash = ?',
+                (digest,)).fetchone()
+        if row:
+            fetched, ok, body = row
+            if self.offline or fetched + (self.ttl if ok else self.failure_ttl) > time.time():
+                value = json.loads(zlib.decompress(body))
+                if not ok:
+                    raise CachedFailure(value)
+                return value
+        if self.offline:
+            raise NotCached(f'{kind} lookup for {key} is not cached')
+
+        try:
+            value = fetch()
+        except failures as e:
+            self._store(digest, kind, False, ' '.join(map(str, e.args)))
+            raise
+        self._store(digest, kind, True, value)
+        return value
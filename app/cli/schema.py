@@ -0,0 +1,15 @@
+import sys
+
+from .. import migrations
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+def migrate(args):
+    applied = migrations.migrate()
+    eprint(f'Applied {applied} migration(s)' if applied else 'Database is up to date')
+
+def status(args):
+    eprint(f'Database is at version {migrations.current_version()}')
+    for version, name, _ in migrations.pending():
+        print(f'Pending migration {version}: {name}')
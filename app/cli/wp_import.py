@@ -1,4 +1,9 @@
+import gzip
+import re
+import time
+from datetime import datetime, timezone
 from getpass import getpass
+from types import SimpleNamespace
 
 import sqlalchemy as sql
 import sqlalchemy.orm as orm
@@ -8,8 +13,9 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.url import URL
 import flask
 
-from .. import db
-from ..models import User, BlogPost
+from .. import db, summarize
+from ..cache import invalidate
+from ..models import User, BlogPost, post_author_association
 
 WpBase = declarative_base()
 
@@ -60,6 +66,56 @@ class WordPressPost(WpBase):
     # Not a column, but a relation to conveniently access the author
     post_user             = orm.relationship('WordPressUser')
 
+def import_authors(wp_session, published):
+    """ Map of WordPress user IDs to our user IDs for the authors of published posts """
+    return import_users(dict(wp_session.query(WordPressUser.id, WordPressUser.user_login)
+            .filter(WordPressUser.id.in_(published.with_entities(WordPressPost.post_author)))))
+
+def import_users(logins):
+    """ Map of WordPress user IDs to our user IDs given a map of WordPress user IDs to usernames,
+    creating any users we don't have yet """
+    users = User.find_or_make([{'name': login} for login in logins.values()])
+    db.session.commit()
+    return {wp_id: user.id for wp_id, user in zip(logins.keys(), users)}
+
+def convert_post(wp_post):
+    """ Columns of a native (to this app) post from the WordPress one """
+    return {
+        'wp_id': wp_post.id,
+        # Import the unescaped title (some _very_ old posts have stuff like &amp;)
+        'title': flask.Markup(wp_post.post_title).unescape(),
+        'time': wp_post.post_date,
+        'edited': wp_post.post_modified or wp_post.post_date,
+        'html': wp_post.post_content,
+        'summary': summarize(wp_post.post_content),
+    }
+
+def save_posts(posts, authors):
+    """ Inserts a batch of converted posts (and their authors, a map of WordPress post IDs to our
+    user IDs) in one transaction """
+    db.session.execute(BlogPost.__table__.insert(), posts)
+    link_authors(authors)
+    db.session.commit()
+
+def link_authors(authors):
+    """ Adds the authors (a map of WordPress post IDs to our user IDs) to imported posts """
+    if not authors:
+        return
+    ids = db.session.query(BlogPost.wp_id, BlogPost.id)\
+            .filter(BlogPost.wp_id.in_(authors.keys()))
+    db.session.execute(post_author_association.insert(),
+            [{'post_id': id, 'author_id': authors[wp_id]} for wp_id, id in ids])
+
+class Progress:
+    def __init__(self):
+        self.count = 0
+        self.start = time.perf_counter()
+
+    def add(self, count):
+        self.count += count
+        elapsed = time.perf_counter() - self.start
+        print(f'Imported {self.count} posts ({self.count / elapsed:.0f} posts/sec)')
+
 def run(args):
     password = getpass(f'Password for {args.user}@{args.address}: ')
     wp_engine = sql.create_engine(URL(
@@ -74,28 +130,169 @@ def run(args):
     ))
 
     WPSession = orm.sessionmaker(bind=wp_engine)
-    wp_session = WPSession()
-    for wp_post in wp_session.query(WordPressPost)\
-            .filter_by(post_type='post', post_status='publish'):
+    import_posts(WPSession(), args.batch)
+
+def import_posts(wp_session, batch_size):
+    """ Imports the published posts from a WordPress database, batch_size at a time """
+    published = wp_session.query(WordPressPost)\
+            .filter_by(post_type='post', post_status='publish')
             # ^^ Everything in WordPress is a goddamn post, we only want
             # published (https://wordpress.org/support/article/post-status/#publish)
             # blog posts (https://wordpress.org/support/article/post-types/#posts)
-        # Import the unescaped title (some _very_ old posts have stuff like &amp;)
-        wp_post.post_title = flask.Markup(wp_post.post_title).unescape()
-
-        print(f'Importing "{wp_post.post_title}" by {wp_post.post_user.user_login} ({wp_post.post_date})...')
-        author = User.find_one(wp_post.post_user.user_login)
-        if not author:
-            print(f'Creating new user "{wp_post.post_user.user_login}"')
-            author = User(name=wp_post.post_user.user_login)
-            db.session.add(author)
-
-        # Create a native (to this app) post from the WordPress one
-        db.session.add(BlogPost(
-            title=wp_post.post_title,
-            authors=[author],
-            time=wp_post.post_date,
-            edited=wp_post.post_modified,
-            html=wp_post.post_content
-        ))
+    authors = import_authors(wp_session, published)
+
+    # Posts are imported in ID order and each batch is committed as a whole, so the last post we
+    # have is where a previous (possibly interrupted) import stopped
+    last_id = db.session.query(db.func.max(BlogPost.wp_id)).scalar() or 0
+    if last_id:
+        print(f'Resuming after WordPress post #{last_id}')
+
+    columns = published.with_entities(WordPressPost.id, WordPressPost.post_author,
+            WordPressPost.post_title, WordPressPost.post_date, WordPressPost.post_modified,
+            WordPressPost.post_content).order_by(WordPressPost.id)
+    progress = Progress()
+    try:
+        while True:
+            # Read in chunks rather than pulling every post's content over at once
+            batch = columns.filter(WordPressPost.id > last_id).limit(batch_size).all()
+            if not batch:
+                break
+
+            save_posts([convert_post(wp_post) for wp_post in batch],
+                    {wp_post.id: authors[wp_post.post_author] for wp_post in batch})
+            last_id = batch[-1].id
+            progress.add(len(batch))
+    except BaseException:
+        # Drop what the interrupted batch wrote so far, it's imported again when resuming
+        db.session.rollback()
+        raise
+    finally:
+        # Only once the batches that did get imported are committed (invalidate() commits too)
+        if progress.count:
+            invalidate('posts')
+
+# Reading a mysqldump file directly, which saves loading it into a database first. Dumps have
+# one (extended) INSERT per line, so only one of those lines is in memory at a time.
+_insert = re.compile(r'INSERT INTO `(\w+)`(?: \(([^)]*)\))? VALUES ')
+_value = re.compile(r"""
+      '(?P<str>[^'\\]*(?:(?:\\.|'')[^'\\]*)*)'
+    | (?P<null>NULL)
+    | (?P<hex>0x[0-9A-Fa-f]*)
+    | (?P<num>-?[0-9][0-9.eE+-]*)
+    | (?P<open>\()
+    | (?P<close>\))
+    | [\s,;]+
+    """, re.VERBOSE | re.DOTALL)
+_escape = re.compile(r"\\(.)|''", re.DOTALL)
+_escapes = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+
+def _unescape(match):
+    char = match.group(1)
+    return "'" if char is None else _escapes.get(char, char)
+
+def _values(line, pos):
+    """ Yields each row (as a list of values) of the VALUES list of an INSERT starting at pos """
+    row = None
+    while pos < len(line):
+        match = _value.match(line, pos)
+        if not match:
+            raise ValueError(f'Unexpected {line[pos:pos+20]!r} in dump')
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'open':
+            row = []
+        elif kind == 'close':
+            yield row
+        elif kind == 'str':
+            row.append(_escape.sub(_unescape, match.group('str')))
+        elif kind == 'null':
+            row.append(None)
+        elif kind == 'hex':
+            row.append(bytes.fromhex(match.group('hex')[2:]))
+        elif kind == 'num':
+            num = match.group('num')
+            row.append(int(num) if num.lstrip('-').isdigit() else float(num))
+
+def dump_rows(lines, tables):
+    """ Yields (table, row) for every row inserted into one of tables, each row being a dict of
+    (lower case) column names to values """
+    columns, creating = {}, None
+    for line in lines:
+        if creating:
+            # Column definitions look like "  `post_title` text NOT NULL,"
+            if line.startswith('  `'):
+                columns[creating].append(line.split('`')[1].lower())
+            elif line.startswith(')'):
+                creating = None
+        elif line.startswith('CREATE TABLE `'):
+            table = line.split('`')[1]
+            if table in tables:
+                creating = table
+                columns[table] = []
+        elif line.startswith('INSERT INTO `'):
+            match = _insert.match(line)
+            if not match or match.group(1) not in tables:
+                continue
+            table = match.group(1)
+            names = [c.strip(' `').lower() for c in match.group(2).split(',')]\
+                    if match.group(2) else columns[table]
+            for row in _values(line, match.end()):
+                yield table, dict(zip(names, row))
+
+def _dump_time(value):
+    # Same as reading the UtcDateTime columns from the database, where zero dates come back as None
+    if not value or value.startswith('0000-00-00'):
+        return None
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+
+def run_dump(args):
+    opener = gzip.open if args.file.endswith('.gz') else open
+    imported = {wp_id for wp_id, in db.session.query(BlogPost.wp_id).filter(BlogPost.wp_id.isnot(None))}
+
+    # Posts come before users in a dump (tables are in alphabetical order), so authors are
+    # only linked once we've seen the users
+    authors, logins, batch = {}, {}, []
+    progress = Progress()
+    linked = False
+    try:
+        with opener(args.file, 'rt', encoding='utf-8', errors='replace') as lines:
+            for table, row in dump_rows(lines, ('news_wp_posts', 'news_wp_users')):
+                if table == 'news_wp_users':
+                    logins[row['id']] = row['user_login']
+                    continue
+                # Only published blog posts (see run())
+                if row['post_type'] != 'post' or row['post_status'] != 'publish':
+                    continue
+
+                authors[row['id']] = row['post_author']
+                if row['id'] in imported:
+                    continue
+                for col in ('post_date', 'post_modified'):
+                    row[col] = _dump_time(row[col])
+                batch.append(convert_post(SimpleNamespace(**row)))
+
+                if len(batch) >= args.batch:
+                    save_posts(batch, None)
+                    progress.add(len(batch))
+                    batch = []
+            if batch:
+                save_posts(batch, None)
+                progress.add(len(batch))
+
+        users = import_users({id: logins[id] for id in set(authors.values())})
+        # Also covers posts from an earlier interrupted import which didn't get this far
+        unlinked = {wp_id for wp_id, in db.session.query(BlogPost.wp_id)
+                .filter(BlogPost.wp_id.isnot(None), ~BlogPost.authors.any())}
+        wp_ids = [wp_id for wp_id in authors if wp_id in unlinked]
+        for i in range(0, len(wp_ids), args.batch):
+            link_authors({wp_id: users[authors[wp_id]] for wp_id in wp_ids[i:i+args.batch]})
         db.session.commit()
+        linked = bool(wp_ids)
+    except BaseException:
+        # Authors are linked all at once, so an interruption leaves them all to the next run
+        db.session.rollback()
+        raise
+    finally:
+        # Only once the posts that did get imported are committed (invalidate() commits too)
+        if progress.count or linked:
+            invalidate('posts')
@@ -0,0 +1,108 @@
+import gzip
+import threading
+from collections import OrderedDict
+from itertools import chain
+
+import brotli
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_options_header, quote_etag, unquote_etag
+from werkzeug.wsgi import ClosingIterator
+
+# Compresses responses (with brotli or gzip, whichever the client prefers) on their way out of the
+# app. Pages with an ETag (see cache.validated()) describe exactly what's in them, so their
+# compressed bodies are kept and e.g. a popular post is only compressed once per worker, not once
+# per request.
+
+COMPRESSIBLE = {'text/html', 'text/css', 'text/plain', 'text/xml', 'application/json',
+        'application/javascript', 'application/xml', 'image/svg+xml', 'image/x-icon',
+        'image/vnd.microsoft.icon'}
+# In order of preference when the client doesn't prefer either
+ENCODINGS = ('br', 'gzip')
+
+def negotiate(accept_encoding):
+    """ The encoding to use given an Accept-Encoding header, None for no compression """
+    accept = parse_accept_header(accept_encoding)
+    best = max(ENCODINGS, key=lambda e: (accept[e], -ENCODINGS.index(e)))
+    return best if accept[best] > 0 else None
+
+class Compress:
+    """ WSGI middleware compressing responses of at least min_size bytes. levels has the gzip and
+    brotli levels to use, cache_size is the number of compressed bodies to keep """
+    def __init__(self, app, min_size=500, levels=None, cache_size=256):
+        self.app = app
+        self.min_size = min_size
+        self.levels = dict({'gzip': 6, 'br': 5}, **(levels or {}))
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.levels['br'])
+        return gzip.compress(body, compresslevel=self.levels['gzip'], mtime=0)
+
+    def _cached(self, key, body, encoding):
+        """ body compressed with encoding, from the cache if it's been compressed before """
+        if key is not None:
+            with self._lock:
+                compressed = self._cache.get(key)
+                if compressed is not None:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return compressed
+        compressed = self.compress(body, encoding)
+        if key is not None:
+            with self._lock:
+                self.misses += 1
+                self._cache[key] = compressed
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return compressed
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._cache)}
+
+    def __call__(self, environ, start_response):
+        response, body_parts = {}, []
+        def capture(status, headers, exc_info=None):
+            # Nothing has been sent yet, so an error page can always replace the response
+            response.update(status=status, headers=Headers(headers), exc_info=exc_info)
+            return body_parts.append
+        app_iter = self.app(environ, capture)
+
+        headers = response['headers']
+        mimetype = parse_options_header(headers.get('Content-Type', ''))[0]
+        if environ['REQUEST_METHOD'] == 'HEAD' or not response['status'].startswith('200 ') \
+                or mimetype not in COMPRESSIBLE or 'Content-Encoding' in headers \
+                or 'no-transform' in headers.get('Cache-Control', ''):
+            # e.g. images, files that are already compressed, redirects and HEAD requests (which
+            # have the uncompressed Content-Length) go out as they are
+            start_response(response['status'], headers.to_wsgi_list(), response['exc_info'])
+            if body_parts:
+                return ClosingIterator(chain(body_parts, app_iter), getattr(app_iter, 'close', None))
+            return app_iter
+
+        try:
+            body = b''.join(chain(body_parts, app_iter))
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+        # Whether the page is compressed depends on the request, caches need to know that
+        if 'accept-encoding' not in headers.get('Vary', '').lower():
+            headers.add('Vary', 'Accept-Encoding')
+        encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding and len(body) >= self.min_size:
+            key = None
+            if 'ETag' in headers:
+                # Differently compressed pages aren't byte for byte the same, so the tag is weak
+                tag, _ = unquote_etag(headers['ETag'])
+                headers['ETag'] = quote_etag(tag, weak=True)
+                key = (environ.get('PATH_INFO'), environ.get('QUERY_STRING'), tag, encoding)
+            body = self._cached(key, body, encoding)
+            headers['Content-Encoding'] = encoding
+        headers['Content-Length'] = str(len(body))
+        start_response(response['status'], headers.to_wsgi_list(), response['exc_info'])
+        return [body]
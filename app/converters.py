@@ -0,0 +1,40 @@
+import threading
+
+import html2text
+
+# html2text.HTML2Text and markdown.Markdown keep the state of the document being converted on
+# the instance, so sharing one between threads (gunicorn gthread workers, bulk conversions)
+# mixes documents up. Each thread gets its own instances instead, which are reused so we don't
+# pay for setting up Markdown's extensions on every conversion.
+_local = threading.local()
+
+def _summarizer():
+    if not hasattr(_local, 'summarizer'):
+        summarizer = html2text.HTML2Text()
+        summarizer.ignore_links = True
+        summarizer.ignore_anchors = True
+        summarizer.images_to_alt = True
+        summarizer.ignore_emphasis = True
+        summarizer.ignore_tables = True
+        _local.summarizer = summarizer
+    return _local.summarizer
+
+def _markdown():
+    if not hasattr(_local, 'markdown'):
+        # Only the CLI renders Markdown, so the web workers don't need to import it
+        import markdown
+        _local.markdown = markdown.Markdown(output_format='html5')
+    return _local.markdown
+
+def html_to_text(html):
+    """ Plain text version of some HTML, without links, images or formatting """
+    return _summarizer().handle(html)
+
+def html_to_markdown(html):
+    """ Markdown version of some HTML (e.g. to edit an old post) """
+    # Makes a new converter each time, so this one is already safe to share
+    return html2text.html2text(html)
+
+def render_markdown(text):
+    """ HTML for a post written in Markdown """
+    return _markdown().reset().convert(text)
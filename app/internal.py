@@ -0,0 +1,63 @@
+from collections import Counter
+from functools import wraps
+from ipaddress import ip_address
+from os import getpid
+
+from flask import abort, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.pool import Pool, QueuePool
+
+from . import app, db, development
+
+# Pages for keeping an eye on the app, only served to requests made from inside the container
+# (e.g. `docker exec <app container name> curl localhost:8080/_internal/pool`), not through the
+# reverse proxy
+
+def _allowed(remote, networks):
+    try:
+        address = ip_address(remote)
+    except ValueError:
+        return False
+    return address.is_loopback or any(address in network for network in networks)
+
+def internal(view, allow=()):
+    """ Only serves view to requests from inside the container, or (connecting directly, not
+    through the reverse proxy) from the networks in allow """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # ProxyFix replaces remote_addr with the forwarded one, we want who actually connected
+        orig = request.environ.get('werkzeug.proxy_fix.orig', {})
+        remote = orig.get('REMOTE_ADDR', request.remote_addr)
+        if not development and (not _allowed(remote, allow) or 'X-Forwarded-For' in request.headers):
+            abort(404)
+        return view(*args, **kwargs)
+    # So `website export` leaves them out of the public pages
+    wrapper.internal = True
+    return wrapper
+
+# What each worker's connection pool has been up to since it started
+pool_events = Counter()
+def _count(name):
+    def listener(*args):
+        pool_events[name] += 1
+    event.listen(Pool, name, listener)
+for name in ('connect', 'checkout', 'checkin', 'invalidate'):
+    _count(name)
+
+@app.route('/_internal/pool')
+@internal
+def pool_stats():
+    pool = db.engine.pool
+    # Only a QueuePool has a size (e.g. SQLite doesn't pool connections at all)
+    sizes = dict(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+            overflow=pool.overflow()) if isinstance(pool, QueuePool) else {}
+    return jsonify(
+        pid=getpid(),
+        **sizes,
+        # Connections opened, handed out to requests, returned, and thrown away because they
+        # were dead (pre-ping) or broke during a request
+        connects=pool_events['connect'],
+        checkouts=pool_events['checkout'],
+        checkins=pool_events['checkin'],
+        invalidated=pool_events['invalidate'],
+    )
@@ -0,0 +1,219 @@
+import logging
+import threading
+from collections import defaultdict
+from functools import wraps
+from os import getpid
+from time import perf_counter
+
+from flask import Response, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from . import app, db
+from .cache import page_cache
+from .compression import Compress
+from .internal import internal, pool_events
+
+# Where the time goes in each request: database queries, rendering templates and (within
+# rendering) our template filters. Every response gets a Server-Timing header with its own
+# numbers, and /metrics has the totals of this worker in Prometheus' text format. Only set up
+# with METRICS=1, otherwise none of these hooks are installed and nothing is measured.
+
+log = logging.getLogger(__name__)
+
+# Request durations (seconds) counted by the histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    """ Totals for this worker since it started, by endpoint (or filter) """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self.db_seconds = defaultdict(float)
+        self.queries = defaultdict(int)
+        self.template_seconds = defaultdict(float)
+        self.filter_seconds = defaultdict(float)
+        self.filter_calls = defaultdict(int)
+        self.slow_queries = 0
+
+    def add_request(self, endpoint, status, elapsed, timings):
+        with self._lock:
+            self.requests[endpoint, status] += 1
+            self.seconds[endpoint] += elapsed
+            buckets = self.buckets[endpoint]
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    buckets[i] += 1
+            self.db_seconds[endpoint] += timings['db']
+            self.queries[endpoint] += timings['queries']
+            self.template_seconds[endpoint] += timings['template']
+            for name, (calls, seconds) in timings['filters'].items():
+                self.filter_calls[name] += calls
+                self.filter_seconds[name] += seconds
+
+    def add_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def render(self):
+        """ The totals in Prometheus' text exposition format """
+        lines = []
+        def header(name, kind, help):
+            lines.append(f'# HELP netsoc_{name} {help}')
+            lines.append(f'# TYPE netsoc_{name} {kind}')
+        def sample(name, value, **labels):
+            # Each worker keeps its own totals
+            labels['worker'] = getpid()
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f'netsoc_{name}{{{label_str}}} {value}')
+
+        with self._lock:
+            header('requests_total', 'counter', 'Requests handled')
+            for (endpoint, status), n in self.requests.items():
+                sample('requests_total', n, endpoint=endpoint, status=status)
+
+            header('request_duration_seconds', 'histogram', 'Time taken to handle requests')
+            for endpoint, buckets in self.buckets.items():
+                count = sum(n for (e, _), n in self.requests.items() if e == endpoint)
+                for bound, n in zip(BUCKETS, buckets):
+                    sample('request_duration_seconds_bucket', n, endpoint=endpoint, le=bound)
+                sample('request_duration_seconds_bucket', count, endpoint=endpoint, le='+Inf')
+                sample('request_duration_seconds_sum', self.seconds[endpoint], endpoint=endpoint)
+                sample('request_duration_seconds_count', count, endpoint=endpoint)
+
+            header('db_seconds_total', 'counter', 'Time spent in database queries')
+            for endpoint, seconds in self.db_seconds.items():
+                sample('db_seconds_total', seconds, endpoint=endpoint)
+            header('db_queries_total', 'counter', 'Database queries made')
+            for endpoint, n in self.queries.items():
+                sample('db_queries_total', n, endpoint=endpoint)
+            header('db_slow_queries_total', 'counter', 'Queries slower than SLOW_QUERY_MS')
+            sample('db_slow_queries_total', self.slow_queries)
+
+            header('template_seconds_total', 'counter', 'Time spent rendering templates (including filters)')
+            for endpoint, seconds in self.template_seconds.items():
+                sample('template_seconds_total', seconds, endpoint=endpoint)
+            header('filter_seconds_total', 'counter', 'Time spent in template filters')
+            for name, seconds in self.filter_seconds.items():
+                sample('filter_seconds_total', seconds, filter=name)
+            header('filter_calls_total', 'counter', 'Template filter calls')
+            for name, n in self.filter_calls.items():
+                sample('filter_calls_total', n, filter=name)
+
+        cache = page_cache.stats()
+        header('page_cache_hits_total', 'counter', 'Pages served from the page cache')
+        sample('page_cache_hits_total', cache['hits'])
+        header('page_cache_misses_total', 'counter', 'Pages that had to be rendered')
+        sample('page_cache_misses_total', cache['misses'])
+        header('page_cache_entries', 'gauge', 'Pages in this worker\'s cache')
+        sample('page_cache_entries', cache['entries'])
+
+        if isinstance(app.wsgi_app, Compress):
+            compression = app.wsgi_app.stats()
+            header('compression_cache_hits_total', 'counter', 'Responses compressed earlier and reused')
+            sample('compression_cache_hits_total', compression['hits'])
+            header('compression_cache_misses_total', 'counter', 'Responses with an ETag that had to be compressed')
+            sample('compression_cache_misses_total', compression['misses'])
+
+        pool = db.engine.pool
+        if isinstance(pool, QueuePool):
+            header('db_pool_checked_out', 'gauge', 'Connections in use')
+            sample('db_pool_checked_out', pool.checkedout())
+            header('db_pool_checked_in', 'gauge', 'Idle connections')
+            sample('db_pool_checked_in', pool.checkedin())
+        header('db_pool_connects_total', 'counter', 'Connections opened')
+        sample('db_pool_connects_total', pool_events['connect'])
+        header('db_pool_invalidated_total', 'counter', 'Connections thrown away')
+        sample('db_pool_invalidated_total', pool_events['invalidate'])
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def _timings():
+    if 'timings' not in g:
+        g.timings = {'db': 0.0, 'queries': 0, 'template': 0.0, 'filters': defaultdict(lambda: (0, 0.0))}
+    return g.timings
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['query_start'].pop()
+    if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        metrics.add_slow_query()
+        log.warning('Slow query (%.0f ms): %s %r', elapsed * 1000, statement, parameters)
+    if has_request_context():
+        timings = _timings()
+        timings['db'] += elapsed
+        timings['queries'] += 1
+
+def _handle_error(context):
+    # A failed query never gets to after_cursor_execute, drop its start time so the next query
+    # on the connection isn't timed from it
+    starts = context.connection.info.get('query_start') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            if has_request_context():
+                _timings()['template'] += perf_counter() - start
+
+def _timed_filter(name, f):
+    @wraps(f)
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            if has_request_context():
+                filters = _timings()['filters']
+                calls, seconds = filters[name]
+                filters[name] = (calls + 1, seconds + perf_counter() - start)
+    return timed
+
+def _start_request():
+    g.request_start = perf_counter()
+    _timings()
+
+def _finish_request(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = perf_counter() - g.request_start
+    timings = _timings()
+    filter_time = sum(seconds for _, seconds in timings['filters'].values())
+    response.headers['Server-Timing'] = ', '.join((
+        f'db;dur={timings["db"] * 1000:.1f};desc="{timings["queries"]} queries"',
+        f'template;dur={timings["template"] * 1000:.1f}',
+        f'filters;dur={filter_time * 1000:.1f}',
+        f'total;dur={elapsed * 1000:.1f}',
+    ))
+    metrics.add_request(request.endpoint or 'none', response.status_code, elapsed, timings)
+    return response
+
+def metrics_view():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def init():
+    """ Installs the hooks, called once everything (e.g. the template filters) is registered """
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+
+    app.jinja_env.template_class = TimedTemplate
+    # Our own filters, Jinja's built in ones are cheap
+    for name, f in app.jinja_env.filters.items():
+        if getattr(f, '__module__', '').startswith(__package__):
+            app.jinja_env.filters[name] = _timed_filter(name, f)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', internal(metrics_view, allow=app.config['METRICS_ALLOW']))
@@ -0,0 +1,133 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import func, inspect, select
+from sqlalchemy_utc import UtcDateTime
+
+from . import db
+
+# Versioned schema changes, applied by `website db migrate` (never by the web workers). Each
+# migration runs once, in order, and is recorded in schema_migrations. Databases created before
+# migrations existed may already have some of these changes (tables used to be created on
+# startup, some columns were added by hand), so the early ones check before changing anything.
+# New migrations go at the end of MIGRATIONS with the next version number.
+
+schema_migrations = db.Table('schema_migrations', db.Model.metadata,
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.String(120), nullable=False),
+    db.Column('applied', UtcDateTime, nullable=False),
+)
+
+def has_column(table, column):
+    return column in (c['name'] for c in inspect(db.engine).get_columns(table))
+def has_index(table, index):
+    return index in (i['name'] for i in inspect(db.engine).get_indexes(table))
+def mysql():
+    return db.engine.dialect.name == 'mysql'
+
+def create_tables():
+    # Also creates tables added since (e.g. cache_tags), with their current columns
+    db.create_all()
+
+def add_post_summary():
+    if not has_column('blog_posts', 'summary'):
+        db.session.execute('ALTER TABLE blog_posts ADD COLUMN summary TEXT')
+        print('Run `website posts summarize` to fill in summaries for existing posts')
+
+def add_post_wp_id():
+    if not has_column('blog_posts', 'wp_id'):
+        db.session.execute('ALTER TABLE blog_posts ADD COLUMN wp_id BIGINT')
+        # Same name MySQL gives the index of a UNIQUE column
+        db.session.execute('CREATE UNIQUE INDEX wp_id ON blog_posts (wp_id)')
+
+def add_library_search_index():
+    # Only MySQL / MariaDB have FULLTEXT indexes
+    if mysql() and not has_index('library', 'library_search'):
+        db.session.execute('CREATE FULLTEXT INDEX library_search ON library (title, publisher, description)')
+
+def widen_callnumber():
+    # Room for "<ddc> <AUT> (123)" once a prefix has more than 9 books. SQLite doesn't enforce
+    # VARCHAR lengths (and can't change a column's type)
+    if mysql():
+        db.session.execute('ALTER TABLE library MODIFY callnumber VARCHAR(20) NULL')
+
+def merge_duplicate_names(table, association, linked_col):
+    """ Makes everything linked (by association.linked_col) to one of several rows of table with
+    the same name link to the first of them instead, and deletes the others """
+    table, association = db.Model.metadata.tables[table], db.Model.metadata.tables[association]
+    linked_col = association.c[linked_col]
+    # Grouped by the database, so names its collation considers equal are merged
+    duplicates = db.session.execute(select([table.c.name]).group_by(table.c.name)
+            .having(func.count() > 1)).fetchall()
+    for name, in duplicates:
+        keep, *others = [id for id, in db.session.execute(
+                select([table.c.id]).where(table.c.name == name).order_by(table.c.id))]
+        print(f'Merging {len(others)} duplicate(s) of {table.name} "{name}" into #{keep}')
+        # Whatever links to the duplicates (blog posts / books), apart from what's linked already
+        linked = {id for id, in db.session.execute(
+                select([linked_col]).where(association.c.author_id == keep))}
+        moved = {id for id, in db.session.execute(
+                select([linked_col]).where(association.c.author_id.in_(others)))} - linked
+        db.session.execute(association.delete().where(association.c.author_id.in_(others)))
+        if moved:
+            db.session.execute(association.insert(),
+                    [{linked_col.name: id, 'author_id': keep} for id in moved])
+        db.session.execute(table.delete().where(table.c.id.in_(others)))
+
+def add_unique_names():
+    for table, association, linked_col in (
+            ('users', 'blog_post_authors', 'post_id'), ('authors', 'book_authors', 'book_id')):
+        if not has_index(table, f'{table}_name'):
+            merge_duplicate_names(table, association, linked_col)
+            db.session.execute(f'CREATE UNIQUE INDEX {table}_name ON {table} (name)')
+
+def add_book_cover():
+    if not has_column('library', 'cover'):
+        db.session.execute('ALTER TABLE library ADD COLUMN cover VARCHAR(32)')
+        print('Run `website books covers sync` to store covers for existing books')
+
+def add_sort_indexes():
+    if mysql():
+        # 700 characters of utf8mb4 and the id fit in an index key, no book title comes close
+        db.session.execute('ALTER TABLE library MODIFY title VARCHAR(700) NOT NULL')
+    for table, index, columns in (('blog_posts', 'blog_posts_time', 'time, id'),
+            ('library', 'library_title', 'title, id'), ('library', 'library_type', 'type, id')):
+        if not has_index(table, index):
+            db.session.execute(f'CREATE INDEX {index} ON {table} ({columns})')
+
+def add_edited_index():
+    if not has_index('blog_posts', 'blog_posts_edited'):
+        db.session.execute('CREATE INDEX blog_posts_edited ON blog_posts (edited)')
+
+MIGRATIONS = [
+    (1, 'Create tables', create_tables),
+    (2, 'Add blog_posts.summary', add_post_summary),
+    (3, 'Add blog_posts.wp_id', add_post_wp_id),
+    (4, 'Add library_search FULLTEXT index', add_library_search_index),
+    (5, 'Widen library.callnumber', widen_callnumber),
+    (6, 'Add unique users.name and authors.name indexes', add_unique_names),
+    (7, 'Add library.cover', add_book_cover),
+    (8, 'Add indexes for paging posts and sorting books', add_sort_indexes),
+    (9, 'Add blog_posts.edited index', add_edited_index),
+]
+
+def current_version():
+    if schema_migrations.name not in inspect(db.engine).get_table_names():
+        return 0
+    return db.session.query(db.func.max(schema_migrations.c.version)).scalar() or 0
+
+def pending():
+    version = current_version()
+    return [m for m in MIGRATIONS if m[0] > version]
+
+def migrate():
+    """ Applies pending migrations, returns how many there were """
+    todo = pending()
+    schema_migrations.create(db.engine, checkfirst=True)
+    for version, name, apply in todo:
+        print(f'Applying migration {version}: {name}')
+        apply()
+        db.session.execute(schema_migrations.insert(),
+                {'version': version, 'name': name, 'applied': datetime.now(timezone.utc)})
+        # MySQL commits DDL straight away anyway, so each migration is its own step
+        db.session.commit()
+    return len(todo)
@@ -1,10 +1,12 @@
 import enum
 import logging
+import re
 from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy_utc import UtcDateTime
-from sqlalchemy import or_
+from sqlalchemy import literal_column
 
 from . import db
+from .pagination import KeysetPagination
 
 # No such thing as arrays in MySQL - we need a separate table that SQLAlchemy will
 # automagically populate / read so we can access a user's posts and a post's author(s)
@@ -17,8 +19,46 @@ book_author_association = db.Table('book_authors', db.Model.metadata,
     db.Column('author_id', db.Integer, db.ForeignKey('authors.id'), nullable=False)
 )
 
-class User(db.Model):
+class CacheTag(db.Model):
+    __tablename__ = 'cache_tags'
+
+    # Bumped by the CLI whenever something cached under this tag changes (see cache.py)
+    tag      = db.Column(db.String(64), primary_key=True)
+    version  = db.Column(db.Integer, nullable=False, default=0)
+
+class Named:
+    """ Models looked up by their (unique) name """
+    @classmethod
+    def find_or_make(cls, rows):
+        """ An instance for each of rows (dicts of columns, at least the name) in the same order,
+        found with one IN query and with the missing ones inserted in one statement. Rows someone
+        else inserts in the meantime are ignored by the insert and found afterwards """
+        by_name = {}
+        for row in rows:
+            by_name.setdefault(row['name'], row)
+        found = {o.name: o for o in cls.query.filter(cls.name.in_(by_name))}
+
+        missing = [row for name, row in by_name.items() if name not in found]
+        if missing:
+            db.session.execute(cls.__table__.insert()
+                    .prefix_with('IGNORE', dialect='mysql')
+                    .prefix_with('OR IGNORE', dialect='sqlite')
+                    .values(missing))
+            # A locking read sees rows committed by others since this transaction started
+            query = cls.query.filter(cls.name.in_([row['name'] for row in missing]))\
+                    .with_for_update(read=True)
+            found.update({o.name: o for o in query})
+            # What's left is the same name to the database but spelled differently (MariaDB's
+            # collation ignores case, accents and trailing spaces), which only it can match up
+            for name in by_name.keys() - found.keys():
+                found[name] = cls.query.filter(cls.name == name).with_for_update(read=True).one()
+        return [found[row['name']] for row in rows]
+
+class User(Named, db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('users_name', 'name', unique=True),
+    )
 
     id       = db.Column(db.Integer, primary_key=True)
     name     = db.Column(db.String(32), nullable=False)
@@ -31,6 +71,13 @@ class User(db.Model):
 
 class BlogPost(db.Model):
     __tablename__ = 'blog_posts'
+    __table_args__ = (
+        # Pages of the home page are seeked by (time, id), see KeysetPagination
+        db.Index('blog_posts_time', 'time', 'id'),
+        # The home page's ETag has the latest edit time (see posts_version()), which this makes
+        # one index lookup instead of a scan of every post
+        db.Index('blog_posts_edited', 'edited'),
+    )
 
     id       = db.Column(db.Integer, primary_key=True)
     title    = db.Column(db.Text, nullable=False)
@@ -38,13 +85,30 @@ class BlogPost(db.Model):
     edited   = db.Column(UtcDateTime, nullable=False)
     markdown = db.Column(LONGTEXT, nullable=True)
     html     = db.Column(LONGTEXT, nullable=False)
+    # Precomputed from html (see summarize()) for the home page
+    summary  = db.Column(db.Text, nullable=True)
+    # ID of the WordPress post this was imported from (if any)
+    wp_id    = db.Column(db.BigInteger, unique=True, nullable=True)
 
     @classmethod
     def find_one(cls, id):
-        return cls.query.filter_by(id=id).first()
+        return cls.query.options(db.joinedload('authors')).filter_by(id=id).first()
 
-class BookAuthor(db.Model):
+    @classmethod
+    def list_query(cls):
+        """ Query for list views - post bodies are only loaded if accessed and
+        authors are loaded for the whole list in one go """
+        return cls.query.options(
+            db.defer('markdown'),
+            db.defer('html'),
+            db.selectinload('authors'),
+        )
+
+class BookAuthor(Named, db.Model):
     __tablename__ = 'authors'
+    __table_args__ = (
+        db.Index('authors_name', 'name', unique=True),
+    )
 
     id        = db.Column(db.Integer, primary_key=True)
     name      = db.Column(db.String(64), nullable=False)
@@ -64,10 +128,20 @@ class BookTypes(enum.Enum):
 
 class Book(db.Model):
     __tablename__ = 'library'
+    # Columns searched by find_all(search='all'), backed by a FULLTEXT index
+    search_columns = ('title', 'publisher', 'description')
+    # Columns find_all() can sort by, each with an index to seek pages on (the unique ones have one)
+    sort_columns = ('title', 'callnumber', 'isbn', 'isbn13', 'type')
+    __table_args__ = (
+        db.Index('library_search', *search_columns, mysql_prefix='FULLTEXT'),
+        db.Index('library_title', 'title', 'id'),
+        db.Index('library_type', 'type', 'id'),
+    )
 
     id          = db.Column(db.Integer, primary_key=True)
-    title       = db.Column(db.Text, nullable=False)
-    callnumber  = db.Column(db.String(15), unique=True, nullable=True)
+    # Not TEXT, which MySQL can only index the start of (and so can't sort with the index)
+    title       = db.Column(db.String(700), nullable=False)
+    callnumber  = db.Column(db.String(20), unique=True, nullable=True)
     isbn        = db.Column(db.String(10), unique=True, nullable=True)
     isbn13      = db.Column(db.String(13), unique=True, nullable=False)
     image_url   = db.Column(db.Text, nullable=True)
@@ -77,35 +151,77 @@ class Book(db.Model):
     rating      = db.Column(db.Float, nullable=True)
     num_pages   = db.Column(db.Integer, nullable=True)
     edition     = db.Column(db.String(40), nullable=True)
+    # Hash of the cover image, which is stored locally in a few sizes (see cover_file())
+    cover       = db.Column(db.String(32), nullable=True)
+
+    @staticmethod
+    def cover_file(cover, size):
+        """ Where a size (see cli/covers.py) of a cover is stored, relative to COVERS_PATH """
+        return f'{cover[:2]}/{cover}-{size}.jpg'
+
+    @classmethod
+    def list_query(cls):
+        """ Query for list views - the description is only loaded if accessed and
+        authors are loaded for the whole list in one go """
+        return cls.query.options(
+            db.defer('description'),
+            db.selectinload('authors').defer('about'),
+        )
+
+    @classmethod
+    def search_match(cls, key):
+        """ Full-text match of every word in key (as a prefix) against search_columns,
+        usable both as a filter and as a relevance score - None if key has no usable words or
+        the database isn't MySQL / MariaDB (no FULLTEXT index, e.g. SQLite in the benchmarks) """
+        if db.engine.dialect.name != 'mysql':
+            return None
+        # Strip boolean mode operators, InnoDB ignores words shorter than 3 characters
+        words = [w for w in re.split(r'[\s+\-<>()~*"@]+', key or '') if len(w) >= 3]
+        if not words:
+            return None
+
+        columns = ', '.join(f'{cls.__tablename__}.{col}' for col in cls.search_columns)
+        return literal_column(columns, type_=db.Text).match(' '.join(f'+{w}*' for w in words))
 
     @classmethod
-    def find_all(cls, search=None, key=None, sort=None, desc=None, items=20, page=None):
+    def find_all(cls, search=None, key=None, sort=None, desc=None, items=20, page=None, after=None, before=None):
         """ Returns book matching search & sort - on fail returns empty list """
         def like_filter(col):
             return getattr(cls,col).like(f'%{key}%')
 
         try:
-            books = cls.query
+            books = cls.list_query()
+            relevance = None
 
             if search == 'all':
-                columns = cls.__table__.columns.keys()
-                filters = [like_filter(col) for col in columns if col!='id']
-                books = cls.query.filter(or_(*filters))
+                isbn = (key or '').replace('-', '').strip()
+                if re.fullmatch(r'[0-9]{9}[0-9Xx]|[0-9]{13}', isbn):
+                    books = books.filter((cls.isbn == isbn) | (cls.isbn13 == isbn))
+                else:
+                    relevance = cls.search_match(key)
+                    # Too short for the index (e.g. "C") or no index, just look at titles
+                    books = books.filter(like_filter('title') if relevance is None else relevance)
 
             elif search == 'authors':
-                books = cls.query.join(search).\
+                books = books.join(search).\
                     filter(BookAuthor.name.like(f'%{key}%'))
 
             elif search:
-                books = cls.query.filter(like_filter(search))
+                books = books.filter(like_filter(search))
 
-            order = None
-            if sort:
-                order = getattr(cls, sort)
-                if desc: order = order.desc()
+            # Ties (e.g. same title) are broken by id so every book has a fixed position
+            keys = [(cls.id, bool(desc))]
+            if sort and sort != 'id':
+                if sort not in cls.sort_columns:
+                    raise ValueError(f'Can\'t sort books by {sort}')
+                keys.insert(0, (getattr(cls, sort), bool(desc)))
+            elif not sort and relevance is not None:
+                # Relevance isn't something we can seek on, so this has to use OFFSET
+                books, keys = books.order_by(relevance.desc()), None
 
-            return books.order_by(order).paginate(per_page=(int(items) or None))
+            return KeysetPagination(books, keys, per_page=int(items or 20) or 20,
+                page=page, after=after, before=before, total_key=('library', search, key))
 
         except Exception as e:
             logging.error(e)
-            return cls.query.filter(False).paginate()
+            return KeysetPagination(cls.query.filter(False), None, per_page=1)
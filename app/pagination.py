@@ -0,0 +1,156 @@
+import threading
+from collections import OrderedDict
+from math import ceil
+from time import monotonic
+
+from sqlalchemy import and_, or_, false, true
+
+from . import db
+
+# How long (in seconds) a total row count is reused before it's counted again
+TOTAL_TTL = 60
+# Number of totals kept (e.g. one per recent search), the least recently used are dropped
+TOTALS_SIZE = 256
+_totals = OrderedDict()
+_totals_lock = threading.Lock()
+
+def cached_total(key, query):
+    """ Number of rows matched by query - counted at most every TOTAL_TTL seconds per key """
+    if key is None:
+        return query.order_by(None).count()
+
+    with _totals_lock:
+        expires, total = _totals.get(key, (0, None))
+        if key in _totals:
+            _totals.move_to_end(key)
+    if expires < monotonic():
+        total = query.order_by(None).count()
+        with _totals_lock:
+            _totals[key] = (monotonic() + TOTAL_TTL, total)
+            _totals.move_to_end(key)
+            while len(_totals) > TOTALS_SIZE:
+                _totals.popitem(last=False)
+    return total
+
+def _after(column, descending, value):
+    """ Rows ordered strictly after value in a single column (MySQL sorts NULLs first) """
+    if descending:
+        if value is None:
+            return false()
+        cond = column < value
+        return or_(cond, column.is_(None)) if column.nullable else cond
+
+    if value is None:
+        return column.isnot(None)
+    return column > value
+
+def _from(column, descending, value):
+    """ Rows ordered at or after value in a single column """
+    if descending:
+        if value is None:
+            return column.is_(None)
+        cond = column <= value
+        return or_(cond, column.is_(None)) if column.nullable else cond
+    return true() if value is None else column >= value
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+def _seek(keys, values):
+    """ Rows ordered strictly after values across all of keys (compared like a tuple) """
+    (column, descending), value = keys[0], values[0]
+    cond = _after(column, descending, value)
+    if len(keys) == 1:
+        return cond
+    return or_(cond, and_(_equal(column, value), _seek(keys[1:], values[1:])))
+
+def _ordered(query, keys, values=None):
+    """ query ordered by keys, from the row after values if given """
+    if values is not None:
+        column, descending = keys[0]
+        # The first condition says the same as part of the second, but it's one the database
+        # can start an index range scan from (it can't with the ORs)
+        query = query.filter(_from(column, descending, values[0]), _seek(keys, values))
+    return query.order_by(*[column.desc() if descending else column.asc()
+        for column, descending in keys])
+
+class KeysetPagination:
+    """ Page of a query that seeks past the row at the edge of the neighbouring page instead
+    of using OFFSET, so page 1000 costs the same as page 1.
+
+    keys is a list of (column, descending) to order by, the last of which must be the
+    primary key. after / before are the primary key of the last row of the previous page
+    / first row of the next page, page is only kept for display. Passing keys=None falls
+    back to OFFSET pagination (for orderings that can't be seeked, e.g. relevance). """
+
+    def __init__(self, query, keys, per_page, page=None, after=None, before=None, total_key=None):
+        self.per_page = per_page
+        try:
+            self.page = max(int(page or 1), 1)
+        except ValueError:
+            self.page = 1
+        self.total = cached_total(total_key, query)
+        self.has_prev = self.has_next = False
+        # The first page is linked without any arguments
+        self._prev_args = {'page': self.page - 1} if self.page > 2 else {}
+
+        if keys is None:
+            self.items = query.offset((self.page-1) * per_page).limit(per_page + 1).all()
+            self.has_prev = self.page > 1
+            self.has_next = len(self.items) > per_page
+            del self.items[per_page:]
+            self._edges = (None, None)
+            return
+
+        cursor, pk = after or before, keys[-1][0]
+        boundary = None
+        if cursor:
+            boundary = db.session.query(*[column for column, _ in keys])\
+                    .filter(pk == cursor).first()
+        if boundary is None:
+            # No (or a deleted) cursor row - start from the beginning
+            self.page, before = 1, None
+
+        forward = not before
+        backwards = [(column, not descending) for column, descending in keys]
+        # Walk backwards from the first row of the next page, then flip the results
+        self.items = _ordered(query, keys if forward else backwards, boundary)\
+                .limit(per_page + 1).all()
+        more = len(self.items) > per_page
+        del self.items[per_page:]
+
+        if forward:
+            self.has_prev, self.has_next = boundary is not None, more
+        else:
+            self.items.reverse()
+            self.has_prev, self.has_next = more, True
+        self._edges = (getattr(self.items[0], pk.key), getattr(self.items[-1], pk.key))\
+                if self.items else (None, None)
+
+        if self.has_prev and self.items:
+            # The previous page is linked by its own "after" (the row before it) rather than
+            # before=, so every page has the one URL reached from page 1, which is what caches
+            # keep and `website export` writes
+            first = [getattr(self.items[0], column.key) for column, _ in keys]
+            prev_after = _ordered(query.with_entities(pk), backwards, first)\
+                    .offset(per_page).limit(1).scalar()
+            self._prev_args = {'page': self.page - 1, 'after': prev_after}\
+                    if prev_after is not None else {}
+
+    @property
+    def pages(self):
+        return max(ceil(self.total / self.per_page), 1) if self.per_page else 1
+
+    @property
+    def prev_args(self):
+        """ URL arguments for the previous page """
+        return self._prev_args
+
+    @property
+    def next_args(self):
+        """ URL arguments for the next page """
+        _, last = self._edges
+        args = {'page': self.page + 1}
+        if last is not None:
+            args['after'] = last
+        return args
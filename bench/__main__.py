@@ -0,0 +1,412 @@
+""" Benchmarks for the web views and the CLI's hot paths, against synthetic data at one or more
+scales. Run from the repository root:
+
+    python -m bench --scales 1000 10000 -o results.json
+    python -m bench --compare results.json    # against an earlier run (e.g. another commit)
+
+By default everything runs against a throwaway SQLite database; --db takes a database URL instead
+(e.g. a local MariaDB, which is needed for the full-text library search). """
+import argparse
+import html
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime, timezone
+from time import perf_counter
+
+from . import data, stub
+
+# Library searches as the search form makes them, with a key that matches some of the books
+SEARCHES = {
+    None: None,
+    'title': 'python',
+    'all': 'python server',
+    'authors': 'Author 1',
+    'description': 'kernel',
+    'isbn': '00000001',
+    'isbn13': '97800000',
+    'publisher': 'Press',
+    'type': 'literature',
+}
+SORTS = (None, 'id', 'title', 'callnumber', 'isbn', 'isbn13', 'type')
+# Compression levels compared for the size of each page and the time taken
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 4, 5, 7, 9, 11)}
+# Most queries each page / CLI listing may make, whatever the scale. Authors are loaded for a whole
+# page at once, loading them row by row would add one query per post or book
+QUERIES = {
+    'home': 4,
+    'post': 3,
+    'library': 3,
+    'book': 2,
+    'posts list': 2,
+    'books list': 2,
+}
+NEXT_PAGE = re.compile(r'href="([^"]*after=[^"]*)"')
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+def summary(times, **extra):
+    ms = [t * 1000 for t in times]
+    return dict(runs=len(ms), mean_ms=round(statistics.mean(ms), 4), median_ms=round(statistics.median(ms), 4),
+            min_ms=round(min(ms), 4), max_ms=round(max(ms), 4), **extra)
+
+def timed(f, runs):
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        f()
+        times.append(perf_counter() - start)
+    return times
+
+def bench_views(app, args):
+    from app.models import BlogPost
+    import random
+    client = app.test_client()
+    results = {}
+
+    def get(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f'{url} returned HTTP {response.status_code}')
+        return response
+
+    results['home'] = summary(timed(lambda: get('/'), args.runs))
+
+    # Follow the "next page" links like someone reading through the whole blog
+    url, times = '/', []
+    for _ in range(args.pages):
+        start = perf_counter()
+        body = get(url).get_data(as_text=True)
+        times.append(perf_counter() - start)
+        next_page = NEXT_PAGE.search(body)
+        if not next_page:
+            break
+        url = html.unescape(next_page.group(1))
+    results['home paging'] = summary(times)
+
+    with app.app_context():
+        ids = [id for id, in BlogPost.query.with_entities(BlogPost.id)]
+    rng = random.Random(1)
+    posts = [rng.choice(ids) for _ in range(args.runs)]
+    results['post'] = summary([t for id in posts for t in timed(lambda: get(f'/posts/{id}'), 1)])
+
+    results['library'] = summary(timed(lambda: get('/library/'), args.runs))
+    return results
+
+def count_queries(app, db):
+    """ Number of queries made by each of QUERIES """
+    from argparse import Namespace
+    from sqlalchemy import event
+    from app.cli import blog, library
+    from app.models import BlogPost, Book
+    client = app.test_client()
+    with app.app_context():
+        post = db.session.query(db.func.max(BlogPost.id)).scalar()
+        book = db.session.query(db.func.max(Book.id)).scalar()
+    def cli(command):
+        with app.app_context(), redirect_stdout(io.StringIO()):
+            command(Namespace(limit=10, reverse=False))
+    runs = {
+        'home': lambda: client.get('/'),
+        'post': lambda: client.get(f'/posts/{post}'),
+        'library': lambda: client.get('/library/'),
+        'book': lambda: client.get(f'/library/book/{book}'),
+        'posts list': lambda: cli(blog.list),
+        'books list': lambda: cli(library.list),
+    }
+
+    counts = {}
+    count = 0
+    def listener(*args):
+        nonlocal count
+        count += 1
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        for name, run in runs.items():
+            # Once first so per-worker caches (e.g. row counts) are as they'd usually be
+            run()
+            count = 0
+            run()
+            counts[name] = count
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    return counts
+
+def bench_find_all(app, db, args):
+    from app import pagination
+    from app.models import Book
+    results = {}
+
+    def find(search, key, sort):
+        # Counts are cached for a while, time them too
+        pagination._totals.clear()
+        books = Book.find_all(search=search, key=key, sort=sort)
+        return len(books.items), books.total
+
+    with app.test_request_context():
+        # search=all only uses the FULLTEXT index on MariaDB, elsewhere it's a LIKE on titles
+        for search, key in SEARCHES.items():
+            for sort in SORTS:
+                rows, total = find(search, key, sort)
+                name = f'find_all search={search} sort={sort}'
+                results[name] = summary(timed(lambda: find(search, key, sort), args.runs), rows=rows, total=total)
+    return results
+
+def bench_filters(app, args):
+    from app import summarize
+    from app.models import BlogPost, Book
+    results = {}
+    with app.test_request_context():
+        post = BlogPost.find_one(1)
+        book = Book.query.get(1)
+        filters = app.jinja_env.filters
+        cases = {
+            'html2text': lambda: filters['html2text'](book.description),
+            'pretty_authors': lambda: filters['pretty_authors'](post),
+            'post_date': lambda: filters['post_date'](post.time),
+            'summarize': lambda: summarize(post.html),
+        }
+        for name, f in cases.items():
+            results[f'filter {name}'] = summary(timed(f, args.runs * 10))
+    return results
+
+def bench_compression(app, db, args):
+    from app.compression import Compress
+    from app.models import BlogPost
+    results = {}
+    with app.app_context():
+        biggest = db.session.query(BlogPost.id)\
+                .order_by(db.func.length(BlogPost.html).desc()).limit(1).scalar()
+    pages = {'home': '/', 'post': f'/posts/{biggest}', 'library': '/library/'}
+    client = app.test_client()
+
+    for name, url in pages.items():
+        body = client.get(url).get_data()
+        for encoding, levels in LEVELS.items():
+            for level in levels:
+                compress = Compress(None, levels={encoding: level})
+                size = len(compress.compress(body, encoding))
+                results[f'compress {name} {encoding}-{level}'] = summary(
+                        timed(lambda: compress.compress(body, encoding), args.runs),
+                        bytes=len(body), compressed_bytes=size, ratio=round(size / len(body), 3))
+
+    # The whole request for the biggest post, compressing it every time and only once
+    original = app.wsgi_app
+    try:
+        for name, cache_size in (('uncached', 0), ('cached', 16)):
+            app.wsgi_app = Compress(original, cache_size=cache_size)
+            get = lambda: client.get(pages['post'], headers={'Accept-Encoding': 'br, gzip'})
+            get()
+            results[f'post compressed ({name})'] = summary(timed(get, args.runs))
+    finally:
+        app.wsgi_app = original
+    return results
+
+def bench_wp_import(app, db, args, tmp):
+    from sqlalchemy import orm
+    from app.cli import wp_import
+    from app.models import BlogPost
+
+    wordpress = data.make_wordpress(f'sqlite:///{tmp}/wordpress.db', args.wp_posts)
+    with app.app_context():
+        session = orm.sessionmaker(bind=wordpress)()
+        start = perf_counter()
+        with redirect_stdout(io.StringIO()):
+            wp_import.import_posts(session, 500)
+        elapsed = perf_counter() - start
+        imported = BlogPost.query.filter(BlogPost.wp_id.isnot(None)).count()
+    return {'wp_import': summary([elapsed], posts=imported, posts_per_sec=round(imported / elapsed, 1))}
+
+def bench_callnumbers(app, db, args):
+    from app.cli.library import CallNumbers
+    from app.models import Book
+    # The stub's books all get this prefix, so `books new` afterwards adds to a crowded one too
+    prefix = '005.133 AUT'
+    with app.app_context():
+        data.crowd_prefix(prefix, args.crowded)
+
+        def allocate():
+            callnumbers = CallNumbers()
+            return [callnumbers.allocate(prefix) for _ in range(args.isbns)]
+
+        def probe():
+            # How call numbers used to be found: a query per one already taken
+            cn, i = prefix, 1
+            while Book.query.filter_by(callnumber=cn).first():
+                cn, i = f'{prefix} ({i})', i + 1
+            return cn
+
+        return {
+            'callnumber allocate': summary(timed(allocate, args.runs), books=args.isbns, crowded=args.crowded),
+            'callnumber probe (one book)': summary(timed(probe, max(args.runs // 5, 1)), crowded=args.crowded),
+        }
+
+def bench_books_new(app, args, batch):
+    from app.cli import library
+    from app.models import Book
+
+    # Different ISBNs for every scale so nothing comes from the lookup cache
+    isbns = [f'979{batch}{i:09d}' for i in range(1, args.isbns + 1)]
+    new_args = argparse.Namespace(list=True, offline=False, jobs=args.jobs, batch=20,
+            literature=False, verbose=False)
+    with app.app_context():
+        stdin, sys.stdin = sys.stdin, io.StringIO('\n'.join(isbns))
+        try:
+            start = perf_counter()
+            with redirect_stderr(io.StringIO()):
+                library.new(new_args)
+            elapsed = perf_counter() - start
+        finally:
+            sys.stdin = stdin
+        added = Book.query.filter(Book.isbn13.in_(isbns)).count()
+    return {'books new': summary([elapsed], books=added, books_per_sec=round(added / elapsed, 1))}
+
+def bench_covers_sync(app, args):
+    import shutil
+    from app.cli import covers
+    from app.models import Book
+    # Everything `books new` just stored, again from scratch
+    shutil.rmtree(app.config['COVERS_PATH'], ignore_errors=True)
+    sync_args = argparse.Namespace(all=True, jobs=args.jobs, processes=None, batch=50)
+    with app.app_context():
+        start = perf_counter()
+        with redirect_stderr(io.StringIO()):
+            covers.sync(sync_args)
+        elapsed = perf_counter() - start
+        stored = Book.query.filter(Book.cover.isnot(None)).count()
+    return {'covers sync': summary([elapsed], covers=stored, covers_per_sec=round(stored / elapsed, 1))}
+
+def reset(app, db):
+    from app import migrations
+    with app.app_context(), redirect_stdout(io.StringIO()):
+        db.session.remove()
+        db.drop_all()
+        migrations.migrate()
+
+def compare(old, new, threshold):
+    """ Prints how each benchmark's median changed, returns whether any got slower than threshold """
+    slower = False
+    for scale, results in new['results'].items():
+        for name, result in results.items():
+            before = old['results'].get(scale, {}).get(name)
+            if not before or not before['median_ms']:
+                continue
+            change = (result['median_ms'] - before['median_ms']) / before['median_ms'] * 100
+            regressed = change > threshold
+            slower = slower or regressed
+            print(f"{scale:>7} {name:<48} {before['median_ms']:10.3f} -> {result['median_ms']:10.3f} ms "
+                    f"{change:+6.1f}%{'  SLOWER' if regressed else ''}")
+    return slower
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True,
+                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Benchmark the website and CLI')
+    parser.add_argument('-s', '--scales', help='Numbers of posts (and books) to benchmark with', type=int, nargs='+', default=[1000])
+    parser.add_argument('-n', '--runs', help='Times to run each benchmark', type=int, default=20)
+    parser.add_argument('--pages', help='Home pages to page through', type=int, default=50)
+    parser.add_argument('--wp-posts', help='Posts in the generated WordPress database', type=int, default=2000)
+    parser.add_argument('--isbns', help='Books to add with `books new`', type=int, default=50)
+    parser.add_argument('--crowded', help='Books already under the call number prefix new books get', type=int, default=500)
+    parser.add_argument('-j', '--jobs', help='Parallel lookups for `books new`', type=int, default=8)
+    parser.add_argument('--latency', help='Seconds each stub Goodreads / Classify response takes', type=float, default=0.02)
+    parser.add_argument('--db', help='Database URL to use instead of a temporary SQLite file (its tables are dropped!)')
+    parser.add_argument('--wipe', help='Allow dropping the tables of a --db that already has some', action='store_true', default=False)
+    parser.add_argument('-o', '--output', help='File to write the JSON results to (default stdout)')
+    parser.add_argument('--compare', help='Earlier results to compare against', metavar='JSON')
+    parser.add_argument('--threshold', help='Percentage slowdown reported as a regression by --compare', type=float, default=10)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='netsoc-bench-')
+    stub_url = stub.start(args.latency)
+    # The app is configured from the environment when it's imported
+    for key, value in {'FLASK_ENV': 'development', 'FLASK_SECRET': 'bench', 'PUBLIC_HOST': 'localhost',
+            'HTTP_PORT': '8080', 'GR_KEY': 'bench', 'GR_SECRET': 'bench'}.items():
+        os.environ.setdefault(key, value)
+    os.environ.update({
+        'DATABASE_URL': args.db or f'sqlite:///{tmp}/bench.db',
+        'PAGE_CACHE': '0',
+        'METRICS': '0',
+        'COMPRESS': '0',
+        'GR_URL': stub_url + '/',
+        'CLASSIFY_URL': stub_url + '/classify',
+        'LOOKUP_INTERVAL': '0',
+        'LOOKUP_CACHE': os.path.join(tmp, 'lookups.sqlite'),
+        'COVERS_PATH': os.path.join(tmp, 'covers'),
+    })
+    from sqlalchemy import inspect
+    from app import app, db
+
+    with app.app_context():
+        if args.db and inspect(db.engine).get_table_names() and not args.wipe:
+            eprint(f'{args.db} already has tables, pass --wipe to drop them')
+            sys.exit(1)
+
+    results, queries, over_budget = {}, {}, []
+    for batch, scale in enumerate(args.scales, 1):
+        eprint(f'Seeding {scale} posts and books')
+        reset(app, db)
+        with app.app_context():
+            data.seed(scale, scale)
+
+        eprint('  query counts')
+        queries[str(scale)] = count_queries(app, db)
+        for name, count in queries[str(scale)].items():
+            if count > QUERIES[name]:
+                over_budget.append(f'{name} made {count} queries at scale {scale} (at most {QUERIES[name]})')
+
+        scale_results = {}
+        for name, bench in (
+                ('views', lambda: bench_views(app, args)),
+                ('Book.find_all', lambda: bench_find_all(app, db, args)),
+                ('template filters', lambda: bench_filters(app, args)),
+                ('compression', lambda: bench_compression(app, db, args)),
+                ('WordPress import', lambda: bench_wp_import(app, db, args, tmp)),
+                ('call numbers', lambda: bench_callnumbers(app, db, args)),
+                ('books new', lambda: bench_books_new(app, args, batch)),
+                ('covers sync', lambda: bench_covers_sync(app, args))):
+            eprint(f'  {name}')
+            scale_results.update(bench())
+        results[str(scale)] = scale_results
+
+    output = {
+        'commit': git_commit(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': db.engine.dialect.name,
+        'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'db', 'wipe')},
+        'results': results,
+        'queries': queries,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    for msg in over_budget:
+        eprint(msg)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), output, args.threshold):
+                sys.exit(1)
+    if over_budget:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy as sql
+from sqlalchemy.dialects.mysql import BIGINT, INTEGER, LONGTEXT, MEDIUMTEXT
+from sqlalchemy.ext.compiler import compiles
+
+# Synthetic data for the benchmarks. Everything is generated from a fixed seed, so every run
+# (and every commit being compared) benchmarks against the same rows.
+
+# The models use some MySQL specific column types, give SQLite something it understands instead
+@compiles(LONGTEXT, 'sqlite')
+@compiles(MEDIUMTEXT, 'sqlite')
+def _sqlite_text(type_, compiler, **kw):
+    return 'TEXT'
+@compiles(BIGINT, 'sqlite')
+@compiles(INTEGER, 'sqlite')
+def _sqlite_integer(type_, compiler, **kw):
+    return 'INTEGER'
+
+WORDS = ('python linux network server kernel database compiler society student member event '
+        'meeting talk workshop election committee library book website email account password '
+        'systems security hardware software cluster storage backup release update netsoc').split()
+PUBLISHERS = ('O\'Reilly Media', 'Addison-Wesley', 'No Starch Press', 'Prentice Hall', 'Manning', 'Apress')
+START = datetime(2005, 1, 1, tzinfo=timezone.utc)
+
+def words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+def paragraphs(rng, n):
+    return ''.join(f'<p>{words(rng, 60)} <a href="https://netsoc.ie">{words(rng, 2)}</a></p>' for _ in range(n))
+
+def _insert(table, rows, chunk=2000):
+    from app import db
+    for i in range(0, len(rows), chunk):
+        db.session.execute(table.insert(), rows[i:i+chunk])
+    db.session.commit()
+
+def seed(posts, books, seed=1):
+    """ Fills the (empty) database with posts and books, plus their users and authors """
+    from app import summarize
+    from app.models import User, BlogPost, BookAuthor, Book, BookTypes, \
+            post_author_association, book_author_association
+    rng = random.Random(seed)
+
+    users = 20
+    _insert(User.__table__, [{'id': i, 'name': f'user{i}'} for i in range(1, users + 1)])
+
+    rows, authors = [], []
+    for i in range(1, posts + 1):
+        # Now and then a long one, like some of the old WordPress posts
+        html = paragraphs(rng, rng.randint(2, 8) if i % 50 else rng.randint(50, 150))
+        time = START + timedelta(hours=i * 6)
+        rows.append({'id': i, 'title': words(rng, 5), 'time': time, 'edited': time,
+                'html': html, 'summary': summarize(html)})
+        for author in rng.sample(range(1, users + 1), rng.randint(1, 2)):
+            authors.append({'post_id': i, 'author_id': author})
+    _insert(BlogPost.__table__, rows)
+    _insert(post_author_association, authors)
+
+    book_authors = max(books // 5, 1)
+    _insert(BookAuthor.__table__, [{'id': i, 'name': f'Author {i} {rng.choice(WORDS).title()}'}
+            for i in range(1, book_authors + 1)])
+    rows, authors = [], []
+    for i in range(1, books + 1):
+        rows.append({'id': i, 'title': words(rng, 4).title(),
+                'callnumber': f'{rng.randint(0, 999):03d}.{i} {rng.choice(WORDS)[:3].upper()}',
+                'isbn': f'{i:010d}', 'isbn13': f'978{i:010d}',
+                'publisher': rng.choice(PUBLISHERS), 'description': paragraphs(rng, 2),
+                'type': rng.choice(list(BookTypes)).name, 'rating': round(rng.uniform(1, 5), 2),
+                'num_pages': rng.randint(50, 1200)})
+        for author in rng.sample(range(1, book_authors + 1), min(rng.randint(1, 3), book_authors)):
+            authors.append({'book_id': i, 'author_id': author})
+    _insert(Book.__table__, rows)
+    _insert(book_author_association, authors)
+
+def crowd_prefix(prefix, books):
+    """ Adds books taking the call numbers "<prefix>", "<prefix> (1)" ... "<prefix> (books-1)" """
+    from app import db
+    from app.models import Book
+    first = (db.session.query(db.func.max(Book.id)).scalar() or 0) + 1
+    _insert(Book.__table__, [{'id': first + i, 'title': f'Crowded Book {i}',
+            'callnumber': f'{prefix} ({i})' if i else prefix, 'isbn13': f'977{i:010d}'}
+            for i in range(books)])
+
+def make_wordpress(url, posts, seed=1):
+    """ A WordPress database (just the tables the importer reads) with posts, some of which
+    aren't published blog posts """
+    from app.cli.wp_import import WpBase, WordPressUser, WordPressPost
+    rng = random.Random(seed)
+    engine = sql.create_engine(url)
+    WpBase.metadata.drop_all(engine)
+    WpBase.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        conn.execute(WordPressUser.__table__.insert(),
+                [{'id': i, 'user_login': f'wpuser{i}'} for i in range(1, 11)])
+        rows = []
+        for i in range(1, posts + 1):
+            time = START + timedelta(days=i)
+            rows.append({'id': i, 'post_author': rng.randint(1, 10), 'post_date': time,
+                    'post_date_gmt': time, 'post_modified': time,
+                    'post_content': paragraphs(rng, rng.randint(2, 8)),
+                    'post_title': f'{words(rng, 4)} &amp; {words(rng, 1)}',
+                    'post_status': 'publish' if i % 10 else 'draft',
+                    'post_type': 'post' if i % 7 else 'page'})
+            if len(rows) == 2000:
+                conn.execute(WordPressPost.__table__.insert(), rows)
+                rows = []
+        if rows:
+            conn.execute(WordPressPost.__table__.insert(), rows)
+    return engine
@@ -0,0 +1,66 @@
+import io
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# Stand-ins for the Goodreads API and OCLC Classify, so `books new` can be benchmarked without the
+# network. Every response takes `latency` seconds, like a real (nearby) server.
+
+GOODREADS_BOOK = '''<?xml version="1.0" encoding="UTF-8"?>
+<GoodreadsResponse><book>
+<id>{n}</id><title>Benchmark Book {n}</title><isbn>{isbn10}</isbn><isbn13>{isbn}</isbn13>
+<image_url>http://{host}/covers/{n}.jpg</image_url><publisher>No Starch Press</publisher>
+<description>A book about benchmarks, number {n}.</description><average_rating>4.2</average_rating>
+<num_pages>320</num_pages><link>https://www.goodreads.com/book/show/{n}</link>
+<authors><author><id>{author}</id><name>Stub Author{author}</name>
+<link>https://www.goodreads.com/author/show/{author}</link></author></authors>
+</book></GoodreadsResponse>'''
+
+CLASSIFY = '''<?xml version="1.0" encoding="UTF-8"?>
+<classify xmlns="http://classify.oclc.org"><response code="2"/>
+<recommendations><ddc><mostPopular holdings="100" nsfa="005.133" sfa="005.133"/></ddc></recommendations>
+</classify>'''
+
+def make_cover():
+    """ A full size (noisy, so it compresses like a photo) JPEG cover """
+    from PIL import Image
+    image = Image.effect_noise((600, 900), 64).convert('RGB')
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0
+    cover = b''
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlsplit(self.path)
+        content_type = 'application/xml'
+        if url.path.endswith('book/isbn'):
+            isbn = parse_qs(url.query)['isbn'][0]
+            n = int(isbn[-6:])
+            body = GOODREADS_BOOK.format(n=n, isbn=isbn, isbn10=isbn[3:], author=n % 50,
+                    host=self.headers['Host']).encode('utf-8')
+        elif url.path.startswith('/covers/'):
+            # Anything after the end of a JPEG is ignored, so every book gets a different image
+            content_type = 'image/jpeg'
+            body = self.cover + url.path.encode('utf-8')
+        else:
+            body = CLASSIFY.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start(latency):
+    """ Starts the stub server on a thread, returns its URL """
+    handler = type('StubHandler', (Handler,), {'latency': latency, 'cover': make_cover()})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
@@ -1,10 +1,16 @@
 #!/bin/sh
 # main application entrypoint
 
+# bring the database schema up to date once, before any workers start
+/usr/local/bin/website db migrate || exit 1
+# and build the static files (only linked in production, development serves them as they are)
+/usr/local/bin/website assets build || exit 1
+
 if [ "$FLASK_ENV" == "development" ]; then
 	# use flask debug server in development
 	exec /usr/local/bin/website app
 else
 	# use gunicorn in production
-	exec gunicorn --workers $GUNICORN_WORKERS --bind :8080 --chdir /opt netsoc:app
+	exec gunicorn --workers $GUNICORN_WORKERS --worker-class $GUNICORN_WORKER_CLASS \
+		--threads $GUNICORN_THREADS --bind :8080 --chdir /opt netsoc:app
 fi
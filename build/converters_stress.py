@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+""" Converts the same documents from many threads at once and checks every result is identical to
+converting them one at a time, failing if the HTML / Markdown converters (see app/converters.py)
+mix documents up. Run from inside the app container, e.g. `python /opt/converters_stress.py -t 32` """
+import argparse
+import importlib
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+def markdown_doc(rng, i):
+    # Reference links are remembered by a Markdown instance until it's reset, so documents using
+    # [ref] without defining it come out differently if another document's definition leaks in
+    lines = [f'# Post {i}', '', f'Some *emphasis* and **strong** text in post {i}, '
+            f'with `code` and a [link](https://example.com/{i}).', '']
+    lines += [f'- item {i}.{n}' for n in range(rng.randint(1, 8))]
+    lines += ['', f'See [the reference][ref{i % 7}].', '']
+    if rng.random() < 0.5:
+        lines.append(f'[ref{i % 7}]: https://example.com/ref/{i}')
+    lines += ['', '    indented code', f'    line {i}', '', '> a quote ' * rng.randint(1, 20)]
+    return '\n'.join(lines)
+
+def html_doc(rng, i):
+    rows = ''.join(f'<tr><td>{i}</td><td>{n}</td></tr>' for n in range(rng.randint(0, 5)))
+    paragraphs = ''.join(f'<p>Paragraph {n} of post {i} with <em>emphasis</em>, '
+            f'<a href="https://example.com/{i}/{n}">a link</a> and <img src="/{n}.png" alt="image {n}">.</p>'
+            for n in range(rng.randint(1, 10)))
+    return f'<h2>Post {i}</h2>{paragraphs}<table>{rows}</table><ul><li>{i}</li></ul>'
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the converters give the same results from many threads')
+    parser.add_argument('-t', '--threads', help='Threads converting at once', type=int, default=16)
+    parser.add_argument('-d', '--docs', help='Documents of each kind', type=int, default=200)
+    parser.add_argument('-r', '--rounds', help='Times each document is converted by the threads', type=int, default=20)
+    parser.add_argument('--chdir', help='Directory the app package is in', default='/opt')
+    parser.add_argument('--package', help='Name the app package is imported as', default='netsoc')
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.chdir)
+    converters = importlib.import_module(f'{args.package}.converters')
+    conversions = {
+        'html_to_text': converters.html_to_text,
+        'render_markdown': converters.render_markdown,
+        'html_to_markdown': converters.html_to_markdown,
+    }
+
+    rng = random.Random(1)
+    docs = [('render_markdown', markdown_doc(rng, i)) for i in range(args.docs)]
+    html = [html_doc(rng, i) for i in range(args.docs)]
+    docs += [('html_to_text', doc) for doc in html] + [('html_to_markdown', doc) for doc in html]
+    expected = [conversions[kind](doc) for kind, doc in docs]
+
+    jobs = list(range(len(docs))) * args.rounds
+    rng.shuffle(jobs)
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = pool.map(lambda i: (i, conversions[docs[i][0]](docs[i][1])), jobs)
+        mismatches = [(i, result) for i, result in results if result != expected[i]]
+
+    for i, result in mismatches[:5]:
+        eprint(f'{docs[i][0]} of document {i} differs:\n--- expected\n{expected[i]}\n--- got\n{result}')
+    eprint(f'{len(jobs)} conversions on {args.threads} threads, {len(mismatches)} differed')
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+""" Import time of each `website` command (via `python -X importtime`), failing if a command loads
+a heavy dependency it doesn't need or takes longer than the budget to import. Run from inside the
+app container, e.g. `python /opt/importtime.py --budget 800` """
+import argparse
+import subprocess
+import sys
+
+# Command -> module in app/cli it runs from (see command() in app/cli/__init__.py)
+COMMANDS = {
+    'db': 'schema',
+    'assets': 'assets',
+    'posts': 'blog',
+    'books': 'library',
+    'books new': 'book_lookup',
+    'books covers': 'covers',
+    'export': 'export',
+    'import': 'wp_import',
+}
+# Only the commands listed here should pay for importing these
+HEAVY = {
+    'goodreads': {'books new'},
+    'bs4': {'books new'},
+    'requests': {'books new', 'books covers'},
+    'tqdm': {'books new'},
+    'PIL': {'books new', 'books covers'},
+    'markdown': set(),
+}
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+def import_times(module, args):
+    """ Cumulative import time in microseconds of each top level module imported by the command """
+    result = subprocess.run([args.python, '-X', 'importtime', '-c', f'import {args.package}.cli.{module}'],
+            cwd=args.chdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Nested imports are indented under whatever imported them
+        times[name[1:].rstrip()] = int(cumulative)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of each CLI command')
+    parser.add_argument('-b', '--budget', help='Maximum milliseconds a command may spend importing (0 for no limit)', type=float, default=0)
+    parser.add_argument('-n', '--runs', help='Imports to take the fastest of', type=int, default=3)
+    parser.add_argument('--chdir', help='Directory the app package is in', default='/opt')
+    parser.add_argument('--package', help='Name the app package is imported as', default='netsoc')
+    parser.add_argument('--python', help='Python interpreter to use', default=sys.executable)
+    args = parser.parse_args()
+
+    failed = False
+    for command, module in COMMANDS.items():
+        try:
+            runs = [import_times(module, args) for _ in range(args.runs)]
+        except subprocess.CalledProcessError as e:
+            print(f'{command:<12} failed to import:\n{e.stderr.strip().splitlines()[-1]}')
+            failed = True
+            continue
+        # Only top level imports add up to the whole thing
+        total = min(sum(t for name, t in times.items() if not name.startswith(' ')) for times in runs) / 1000
+        imported = {name.strip() for name in runs[0]}
+        heavy = [name for name, allowed in HEAVY.items() if name in imported and command not in allowed]
+
+        problems = []
+        if heavy:
+            problems.append(f"imports {', '.join(heavy)}")
+        if args.budget and total > args.budget:
+            problems.append(f'over budget of {args.budget:.0f} ms')
+        print(f"{command:<12} {total:7.0f} ms  {'; '.join(problems) or 'ok'}")
+        failed = failed or bool(problems)
+
+    if failed:
+        eprint('Import time check failed')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+""" Load test for the website, reports requests/sec and p50 / p99 latency for the main pages.
+
+Either point it at a running server (-u), or list gunicorn worker classes to start a server with
+each in turn and compare them, e.g. from inside the app container:
+    python /opt/loadtest.py sync gthread gthread:16
+(a class can be followed by :<threads>, otherwise -t is used) """
+import argparse
+import http.client
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+def eprint(msg):
+    print(msg, file=sys.stderr)
+
+def default_host():
+    # The app only answers to its SERVER_NAME (see app/__init__.py)
+    host = os.environ.get('PUBLIC_HOST', 'localhost')
+    if os.environ.get('FLASK_ENV') != 'production':
+        host += f":{os.environ.get('HTTP_PORT', 8080)}"
+    return host
+
+def get(url, host):
+    """ Status and body of url, with a new connection for every request like separate clients """
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    try:
+        conn.request('GET', parts.path + (f'?{parts.query}' if parts.query else ''),
+                headers={'Host': host})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+def percentile(times, p):
+    return times[min(int(len(times) * p), len(times) - 1)]
+
+def load(url, host, concurrency, duration):
+    """ Requests url from concurrency clients for duration seconds """
+    end = time.perf_counter() + duration
+    def client():
+        times, errors = [], 0
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            try:
+                status, _ = get(url, host)
+                ok = status == 200
+            except OSError:
+                ok = False
+            if ok:
+                times.append(time.perf_counter() - start)
+            else:
+                errors += 1
+        return times, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda _: client(), range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    times = sorted(t for client_times, _ in results for t in client_times)
+    return {
+        'requests': len(times),
+        'errors': sum(errors for _, errors in results),
+        'rps': len(times) / elapsed,
+        'p50': percentile(times, 0.5) * 1000 if times else None,
+        'p99': percentile(times, 0.99) * 1000 if times else None,
+    }
+
+def run_all(base, args):
+    status, home = get(base + '/', args.host)
+    if status != 200:
+        raise RuntimeError(f'/ returned HTTP {status}')
+    paths = ['/']
+    post = re.search(rb'/posts/(\d+)', home)
+    if post:
+        paths.append(f'/posts/{post.group(1).decode()}')
+    paths.append('/library/')
+
+    results = {}
+    for path in paths:
+        results[path] = load(base + path, args.host, args.concurrency, args.duration)
+    return results
+
+def print_results(name, results):
+    for path, r in results.items():
+        latency = f"{r['p50']:8.1f} {r['p99']:8.1f}" if r['requests'] else f"{'-':>8} {'-':>8}"
+        print(f"{name:<14} {path:<14} {r['rps']:8.1f} {latency} {r['errors']:7}")
+
+def wait_for(base, host, server, timeout=30, interval=0.1):
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited')
+        try:
+            get(base + '/', host)
+            return
+        except OSError:
+            time.sleep(interval)
+    raise RuntimeError('gunicorn did not start')
+
+def serve(model, args):
+    """ Starts gunicorn with a worker class (and optionally :threads) and load tests it """
+    worker_class, _, threads = model.partition(':')
+    threads = threads or str(args.threads)
+    bind = f'127.0.0.1:{args.port}'
+    # GUNICORN_THREADS also sizes the app's connection pool
+    env = dict(os.environ, GUNICORN_THREADS=threads)
+    server = subprocess.Popen(['gunicorn', '--workers', str(args.workers), '--worker-class', worker_class,
+            '--threads', threads, '--bind', bind, '--chdir', args.chdir, '--log-level', 'warning',
+            args.app], env=env)
+    try:
+        base = f'http://{bind}'
+        wait_for(base, args.host, server)
+        return run_all(base, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the website')
+    parser.add_argument('-u', '--url', help='Server to test (if no worker classes are given)', default='http://localhost:8080')
+    parser.add_argument('-H', '--host', help='Host header to send', default=default_host())
+    parser.add_argument('-c', '--concurrency', help='Concurrent clients', type=int, default=32)
+    parser.add_argument('-d', '--duration', help='Seconds to load each page for', type=float, default=10)
+    parser.add_argument('-w', '--workers', help='gunicorn worker processes', type=int, default=int(os.environ.get('GUNICORN_WORKERS', 4)))
+    parser.add_argument('-t', '--threads', help='gunicorn threads per worker', type=int, default=int(os.environ.get('GUNICORN_THREADS', 8)))
+    parser.add_argument('-p', '--port', help='Port to start gunicorn on', type=int, default=8081)
+    parser.add_argument('--chdir', help='Directory to start gunicorn in', default='/opt')
+    parser.add_argument('--app', help='WSGI app for gunicorn', default='netsoc:app')
+    parser.add_argument('models', help='gunicorn worker classes (e.g. sync, gthread:16, gevent)', nargs='*')
+    args = parser.parse_args()
+
+    print(f"{'worker class':<14} {'page':<14} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    if not args.models:
+        print_results(args.url, run_all(args.url.rstrip('/'), args))
+    for model in args.models:
+        print_results(model, serve(model, args))
+
+if __name__ == '__main__':
+    try:
+        main()
+    except RuntimeError as e:
+        eprint(f'Error: {e}')
+        sys.exit(1)
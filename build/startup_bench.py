@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+""" Startup time benchmark: how long a gunicorn worker takes from starting to answering its first
+request, and how long `website posts list` takes from a cold start. Run from inside the app
+container, e.g. `python /opt/startup_bench.py -n 10` """
+import argparse
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+
+from loadtest import default_host, eprint, wait_for
+
+def boot_time(args):
+    """ Seconds from starting gunicorn with one worker to the first response from / """
+    bind = f'127.0.0.1:{args.port}'
+    start = time.perf_counter()
+    server = subprocess.Popen(['gunicorn', '--workers', '1', '--bind', bind, '--chdir', args.chdir,
+            '--log-level', 'warning', args.app])
+    try:
+        wait_for(f'http://{bind}', args.host, server, interval=0.005)
+        return time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+def cli_time(args):
+    """ Seconds `website posts list` takes to run """
+    start = time.perf_counter()
+    subprocess.run(shlex.split(args.cli) + ['posts', 'list', '-n', '10'], check=True,
+            stdout=subprocess.DEVNULL, cwd=args.chdir)
+    return time.perf_counter() - start
+
+def report(name, times):
+    print(f'{name:<24} min {min(times) * 1000:7.0f} ms   median {statistics.median(times) * 1000:7.0f} ms'
+            f'   max {max(times) * 1000:7.0f} ms')
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure worker boot and CLI cold start times')
+    parser.add_argument('-n', '--runs', help='Times to start each', type=int, default=5)
+    parser.add_argument('-H', '--host', help='Host header to send', default=default_host())
+    parser.add_argument('-p', '--port', help='Port to start gunicorn on', type=int, default=8081)
+    parser.add_argument('--chdir', help='Directory to start gunicorn in', default='/opt')
+    parser.add_argument('--app', help='WSGI app for gunicorn', default='netsoc:app')
+    parser.add_argument('--cli', help='Command to run the CLI', default='website')
+    args = parser.parse_args()
+
+    report('worker boot to first /', [boot_time(args) for _ in range(args.runs)])
+    report('website posts list', [cli_time(args) for _ in range(args.runs)])
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (RuntimeError, subprocess.CalledProcessError) as e:
+        eprint(f'Error: {e}')
+        sys.exit(1)